@@ -1,15 +1,21 @@
 import json
-import wikipediaapi
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from tqdm import tqdm
 
+from utils.mediawiki import retrieve_pages, TITLES_PER_REQUEST, WIKI_LANGUAGES
+from utils.http_client import http_client
+from utils.pipeline_state import load_stale_keys, load_previous_output, is_fresh, save_failed_keys
+from utils.species_store import species_store
+from utils.instrumentation import run_report
+
 #
 # load species data
 #
+run_report.mark("load")
 
 src = "data/collected_id.json"
-tgt = "data/00_species_14991_wikidata.json"
+tgt_table = "wikidata"
 
 # Load the JSON file
 with open(src, "r") as file:
@@ -31,6 +37,14 @@ species_data = {str(i): key for i, key in enumerate(species_data.keys())}
 
 class_metadata = {key: {"scientific_name": value, "eng": {}, "mri": {}} for key, value in species_data.items()}
 print(class_metadata["0"])
+
+# when run incrementally, keep the pages of species whose inputs haven't changed
+stale_keys = load_stale_keys()
+previous_metadata = load_previous_output(tgt_table, stale_keys)
+for key in class_metadata.keys():
+    if is_fresh(key, previous_metadata, stale_keys):
+        class_metadata[key] = previous_metadata[key]
+harvest_keys = [key for key in class_metadata.keys() if not is_fresh(key, previous_metadata, stale_keys)]
 """for key in species_data.keys():
     scientific_name = species_data[key]
     class_metadata[key] = {
@@ -39,80 +53,64 @@ print(class_metadata["0"])
     }"""
 
 #
-# helper functions
+# batched harvester
 #
 
-def collect_wiki_dict(wiki_page: wikipediaapi.WikipediaPage):
-    langlinks = list(wiki_page.langlinks.keys())#{key: value.canonicalurl for key, value in wiki_page.langlinks.items()}
-    links = list(wiki_page.links.keys())#{key: value.canonicalurl for key, value in wiki_page.links.items()}
-    categories = list(wiki_page.categories.keys())#{key: value.canonicalurl for key, value in wiki_page.categories.items()}
-    wiki_dict = {
-        "pageid": wiki_page.pageid,
-        "title": wiki_page.title,
-        "summary": wiki_page.summary,
-        "text": wiki_page.text,
-        "langlinks": langlinks,#wiki_page.langlinks,
-        "links": links,#wiki_page.links,
-        "categories": categories,#wiki_page.categories,
-        "displaytitle": wiki_page.displaytitle,
-        "canonicalurl": wiki_page.canonicalurl,
-        "ns": wiki_page.ns,
-        "contentmodel": wiki_page.contentmodel,
-        "pagelanguage": wiki_page.pagelanguage,
-        "pagelanguagehtmlcode": wiki_page.pagelanguagehtmlcode,
-        "pagelanguagedir": wiki_page.pagelanguagedir,
-        "touched": wiki_page.touched,
-        "lastrevid": wiki_page.lastrevid,
-        "length": wiki_page.length,
-        "protection": wiki_page.protection,
-        "restrictiontypes": wiki_page.restrictiontypes,
-        "watchers": wiki_page.watchers,
-        "notificationtimestamp": wiki_page.notificationtimestamp,
-        "talkid": wiki_page.talkid,
-        "fullurl": wiki_page.fullurl,
-        "editurl": wiki_page.editurl,
-        "readable": wiki_page.readable,
-        "preload": wiki_page.preload
-    }
-    return wiki_dict
+# page fields stored per language; text, links and categories aren't used downstream, and leaving them
+# out lets up to 50 pages be fetched per request with only the extracts, langlinks and info modules
+WIKI_FIELDS = ["pageid", "title", "summary", "langlinks", "displaytitle", "canonicalurl", "fullurl", "ns",
+               "pagelanguage", "touched", "lastrevid", "length"]
+
+# number of batches harvested at once; the request rate per wiki is set by utils/http_client.py
+NUM_WORKERS = 4
+
+
+def harvest_batch(language: str, scientific_names: list):
+    # returns ({scientific name: page dict}, [scientific names whose request failed]) for one batch of titles,
+    # the page dict is empty if the page doesn't exist
+    pages, failed = retrieve_pages(language, scientific_names, WIKI_FIELDS)
+    return {name: pages[name] or {} for name in scientific_names if name in pages}, failed
+
 
 #
 # check how many wikipedia pages can be found
 #
 
-eng_wiki = wikipediaapi.Wikipedia('en')
-mri_wiki = wikipediaapi.Wikipedia('mi')
-
 num_eng_hits, num_mri_hits = 0, 0
+# species of failed batches, harvested again on the next run of the pipeline
+failed_keys = set()
 
+run_report.mark("harvest")
 print("beginning wiki search...\n")
-for key, scientific_name in tqdm(species_data.items(), total=len(species_data)):
-    eng_found = False
-    mri_found = False
-
-    eng_test = eng_wiki.page(scientific_name)
-    mri_test = mri_wiki.page(scientific_name)
-    try:
-        if eng_test.exists():
-            num_eng_hits += 1
-            class_metadata[key]['eng'] = collect_wiki_dict(eng_test)
-            eng_found = True
-        if mri_test.exists():
-            num_mri_hits += 1
-            class_metadata[key]['mri'] = collect_wiki_dict(mri_test)
-            mri_found = True
-    except Exception as e:
-        print(f"error handling name '{scientific_name}': {e}")
-        continue
-    sleep(0.1)
-    #if key == "2":
-    #    print(class_metadata["0"])
+harvest_names = {species_data[key]: key for key in harvest_keys}
+names = list(harvest_names)
+batches = [(lang, language, names[i:i + TITLES_PER_REQUEST])
+           for lang, language in WIKI_LANGUAGES.items() for i in range(0, len(names), TITLES_PER_REQUEST)]
+with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+    futures = {executor.submit(harvest_batch, language, names): (lang, names) for lang, language, names in batches}
+    for future in tqdm(as_completed(futures), total=len(futures)):
+        lang, batch_names = futures[future]
+        try:
+            pages, failed_names = future.result()
+        except Exception as e:
+            print(f"error handling a batch of {lang} pages: {e}")
+            failed_keys.update(harvest_names[name] for name in batch_names)
+            continue
+        failed_keys.update(harvest_names[name] for name in failed_names if name in harvest_names)
+        for scientific_name, page_dict in pages.items():
+            if page_dict:
+                if lang == "eng":
+                    num_eng_hits += 1
+                else:
+                    num_mri_hits += 1
+                class_metadata[harvest_names[scientific_name]][lang] = page_dict
 print()
 print(f"Done! Found {num_eng_hits} English pages, {num_mri_hits} Maori pages...")
 
-# save json
-# Save the list of articles as a JSON file
-with open(tgt, 'w') as json_file:
-    json.dump(class_metadata, json_file)
+# save the articles into the species store, one column per page field
+run_report.mark("save")
+species_store.write(tgt_table, class_metadata)
+save_failed_keys(failed_keys)
 
-print("Articles saved as", tgt)
+print("Articles saved to table", tgt_table)
+http_client.print_stats()
@@ -4,8 +4,16 @@ from os import listdir
 from os.path import split, join
 from collections import Counter
 from utils.csv_tools import load_csv_file, save_as_csv
+from utils.gbif_export import load_gbif_export
 from utils.wikidata_requests import (retrieve_inat_taxon_id_response, retrieve_gbif_vernacular_names,
-                                     retrieve_inat_response)
+                                     retrieve_inat_response, resolve_inat_taxon_ids)
+from utils.response_cache import response_cache
+from utils.taxon_cache import TaxonNodeCache
+from utils.pipeline_state import load_stale_keys, load_previous_output, is_fresh, save_failed_keys
+from utils.journal import RecordJournal
+from utils.species_store import species_store
+from utils.http_client import http_client
+from utils.instrumentation import run_report
 import pandas as pd
 from tqdm import tqdm
 
@@ -15,7 +23,11 @@ from tqdm import tqdm
 
 srcpath = "data/collected_id.json"
 srcpath_speciesdata = "../data/NZ-Species.csv"
-tgtpath = "data/01_species_14991_coredata.json"
+tgt_table = "coredata"
+journalpath = "data/01_species_14991_coredata.journal.jsonl"
+
+# species whose requests failed, recomputed on the next run of the pipeline
+failed_keys = set()
 
 
 #
@@ -23,13 +35,24 @@ tgtpath = "data/01_species_14991_coredata.json"
 #
 
 
-def search_inat_for_kingdom(ancestors: list):
-    for ancestor in ancestors:
-        response = retrieve_inat_response(ancestor)
-        sleep(0.5)
-        if response['results'][0]['rank'] == 'kingdom':
-            return response['results'][0]['name']
-    return None
+def wrap_inat_taxon(taxon: dict):
+    # keep the shape of a /v1/taxa search response, so downstream stages read results[0] as before
+    return {"total_results": 1, "page": 1, "per_page": 1, "results": [taxon]}
+
+
+def build_kingdom_index(speciesdata):
+    # taxonKey -> kingdom hash index, built once; the first row per taxonKey wins
+    speciesdata = speciesdata.drop_duplicates(subset=['taxonKey'])
+    return dict(zip(speciesdata['taxonKey'], speciesdata['kingdom']))
+
+
+def merge_gbif_kingdoms(coredata_frame, kingdom_index):
+    # vectorised lookup for a whole coredata table with a 'gbif' column
+    # adds 'gbif_matched' (taxonKey present in the GBIF data) and 'gbif_kingdom' columns
+    coredata_frame = coredata_frame.copy()
+    coredata_frame['gbif_matched'] = coredata_frame['gbif'].isin(list(kingdom_index.keys()))
+    coredata_frame['gbif_kingdom'] = coredata_frame['gbif'].map(kingdom_index)
+    return coredata_frame
 
 
 #
@@ -37,32 +60,34 @@ def search_inat_for_kingdom(ancestors: list):
 #
 
 
-def get_inat_keys(coredata):
+def get_inat_keys(coredata, journal, completed):
     no_inat_key_found = []
-    for key in tqdm(coredata.keys()):
+    for key in coredata.keys():
         if 'gbif' not in coredata[key]:
             coredata[key]['gbif'] = None
         if 'inat' not in coredata[key]:
             coredata[key]['inat'] = None
-        gbif_key = coredata[key]['gbif']
-        # if the inat key isn't present, attempt to retrieve it
-        key_found = False
-        if not coredata[key]['inat'] and gbif_key:
-            # try to retrieve the inat key from wikidata
-            try:
-                wikidata_response = retrieve_inat_taxon_id_response(gbif_key)
-            except:
-                wikidata_response = None
-            sleep(0.5)
-
-            if wikidata_response and wikidata_response['results']['bindings'] and \
-                    wikidata_response['results']['bindings'][0]:
-                try:
-                    coredata[key]['inat'] = wikidata_response['results']['bindings'][0]['iNat_Taxon_ID']['value']
-
+    # if the inat key isn't present, attempt to retrieve it from wikidata, many gbif keys per query
+    gbif_keys = sorted({str(coredata[key]['gbif']) for key in coredata.keys()
+                        if key not in completed and not coredata[key]['inat'] and coredata[key]['gbif']})
+    print(f"resolving {len(gbif_keys)} gbif keys against wikidata...")
+    resolved, failed = resolve_inat_taxon_ids(gbif_keys)
+    for key in tqdm(coredata.keys()):
+        if key in completed:
+            coredata[key], key_found = completed[key]
+        else:
+            gbif_key = coredata[key]['gbif']
+            key_found = False
+            if not coredata[key]['inat'] and gbif_key:
+                inat_key, _ = resolved.get(str(gbif_key), (None, None))
+                if inat_key:
+                    coredata[key]['inat'] = inat_key
                     key_found = True
-                except:
-                    print(wikidata_response['results']['bindings'][0])
+            # species whose query failed are not journaled, so that a resumed run retries them
+            if str(gbif_key) in failed:
+                failed_keys.add(key)
+            else:
+                journal.append("inat", key, coredata[key]["scientific_name"], coredata[key], key_found)
         if not key_found:
             no_inat_key_found.append(coredata[key]["scientific_name"])
 
@@ -72,9 +97,20 @@ def get_inat_keys(coredata):
     return coredata
 
 
-def get_gbif_and_inat_data(coredata):
+def get_gbif_and_inat_data(coredata, taxon_cache, journal, completed):
     no_response_found = []
+    # retrieve iNat taxa in bulk, many taxon IDs per request
+    inat_keys = [coredata[key]['inat'] for key in coredata.keys() if key not in completed and coredata[key]['inat'] and (
+            'inat_results' not in coredata[key] or not coredata[key]['inat_results'])]
+    print(f"retrieving {len(inat_keys)} inat taxa...")
+    inat_taxa, failed = taxon_cache.fetch(inat_keys)
+    taxon_cache.save()
     for key in tqdm(coredata.keys()):
+        if key in completed:
+            coredata[key], key_found = completed[key]
+            if not key_found:
+                no_response_found.append(coredata[key]["scientific_name"])
+            continue
         gbif_key = coredata[key]['gbif']
         inat_key = coredata[key]['inat']
         # retrieve GBIF and iNat data
@@ -86,7 +122,7 @@ def get_gbif_and_inat_data(coredata):
                     wikidata_response = retrieve_gbif_vernacular_names(gbif_key)
                 except:
                     wikidata_response = None
-                sleep(0.5)
+                    failed_keys.add(key)
                 if wikidata_response is not None and wikidata_response['results']:
                     coredata[key]['gbif_vernacular_response'].extend(wikidata_response['results'])
                     key_found = True
@@ -94,14 +130,17 @@ def get_gbif_and_inat_data(coredata):
         if 'inat_results' not in coredata[key] or not coredata[key]['inat_results']:
             coredata[key]['inat_results'] = []
             if inat_key:
-                try:
-                    coredata[key]['inat_results'] = retrieve_inat_response(inat_key)
-                except:
-                    coredata[key]['inat_results'] = None
-                sleep(0.5)
+                taxon = inat_taxa.get(int(inat_key))
+                coredata[key]['inat_results'] = wrap_inat_taxon(taxon) if taxon else None
+                if int(inat_key) in failed:
+                    failed_keys.add(key)
                 if coredata[key]['inat_results']:
                     key_found = True
 
+        # species whose requests failed in this or an earlier phase aren't journaled either: on resume,
+        # a journaled record would replace the result of their retry
+        if key not in failed_keys:
+            journal.append("responses", key, coredata[key]["scientific_name"], coredata[key], key_found)
         if not key_found:
             no_response_found.append(coredata[key]["scientific_name"])
 
@@ -111,39 +150,50 @@ def get_gbif_and_inat_data(coredata):
     return coredata
 
 
-def get_kingdom(coredata, speciesdata):
+def get_kingdom(coredata, kingdom_index, taxon_cache, journal, completed):
+    # first, attempt to retrieve kingdoms from GBIF data for all species at once
+    coredata_frame = pd.DataFrame({'gbif': [coredata[key]['gbif'] for key in coredata.keys()]},
+                                  index=list(coredata.keys()), dtype=object)
+    coredata_frame = merge_gbif_kingdoms(coredata_frame, kingdom_index)
+    # iNat ancestor lists of the species GBIF can't provide a kingdom for
+    inat_ancestors = {}
     for key in tqdm(coredata.keys()):
-        gbif_key = coredata[key]['gbif']
+        if key in completed:
+            coredata[key] = completed[key][0]
+            continue
         inat_key = coredata[key]['inat']
         # retrieve kingdom from either GBIF or iNat data
-        # first, attempt to retrieve it from GBIF data
         if 'kingdom' not in coredata[key] or not coredata[key]["kingdom"]:
             coredata[key]["kingdom"] = None
             gbif_kingdom = False
-            matches = speciesdata[speciesdata['taxonKey'] == gbif_key]
-            if not matches.empty:
-                kingdom = matches.iloc[0]['kingdom']
-                coredata[key]["kingdom"] = kingdom
+            if coredata_frame.at[key, 'gbif_matched']:
+                coredata[key]["kingdom"] = coredata_frame.at[key, 'gbif_kingdom']
                 gbif_kingdom = True
 
-            # if GBIF couldn't provide a match, attempt to get the kingdom from the iNat API instead
+            # if GBIF couldn't provide a match, fall back to the ancestors in coredata[key]['inat_results']
             if not gbif_kingdom and inat_key:
-                # operate on coredata[key]['inat_results']...
-                # looking for results['results'][0]['ancestor_ids'][1]
                 inat_results = coredata[key]['inat_results']
                 try:
                     ancestors = inat_results['results'][0]['ancestor_ids']
                     proposed_ancestor = ancestors[1]
-
-                    # check if the ancestor in question is indeed the kingdom
-                    proposed_response = retrieve_inat_response(proposed_ancestor)
-                    sleep(0.5)
-                    if proposed_response['results'][0]['rank'] == 'kingdom':
-                        coredata[key]['kingdom'] = proposed_response['results'][0]['name']
-                    else:
-                        coredata[key]['kingdom'] = search_inat_for_kingdom(ancestors)
+                    inat_ancestors[key] = ancestors
                 except:
                     print(f"Couldn't process inat results for {coredata[key]['scientific_name']}; got {inat_results}")
+
+    # the proposed kingdom is usually the second ancestor, fetch those first (shared by thousands of species)
+    failed = taxon_cache.prefetch([ancestors[1] for ancestors in inat_ancestors.values()])
+    # only species whose second ancestor isn't a kingdom need the rest of their ancestor list
+    failed |= taxon_cache.prefetch([ancestor for ancestors in inat_ancestors.values()
+                                    if not taxon_cache.find_kingdom(ancestors[1:2]) for ancestor in ancestors])
+    for key, ancestors in inat_ancestors.items():
+        coredata[key]['kingdom'] = taxon_cache.find_kingdom(ancestors)
+        # a kingdom not found because its ancestors couldn't be fetched is looked up again on the next run
+        if not coredata[key]['kingdom'] and failed & {int(ancestor) for ancestor in ancestors}:
+            failed_keys.add(key)
+    for key in coredata.keys():
+        if key not in completed and key not in failed_keys:
+            journal.append("kingdoms", key, coredata[key]["scientific_name"], coredata[key],
+                           bool(coredata[key]['kingdom']))
     return coredata
 
 
@@ -153,16 +203,15 @@ def get_kingdom(coredata, speciesdata):
 
 
 if __name__ == "__main__":
+    run_report.mark("load")
     # Load the JSON file
     with open(srcpath, "r") as file:
         species_dict = json.load(file)
     # Load species GBIF data
-    dtype_dict = {col: 'str' for col in pd.read_csv(srcpath_speciesdata, nrows=1).columns}
-    speciesdata = pd.read_csv(srcpath_speciesdata, delimiter='	', dtype=dtype_dict)
-    speciesdata = speciesdata.astype({'taxonKey': str})
-    print(speciesdata.columns)
-    speciesdata = speciesdata.loc[:, ["taxonKey", "kingdom"]].drop_duplicates()
-    print(speciesdata.columns)
+    # only the two columns needed, from the Parquet cache of the export
+    speciesdata = load_gbif_export(["taxonKey", "kingdom"], srcpath_speciesdata)
+    speciesdata = speciesdata.astype({'taxonKey': str}).drop_duplicates()
+    kingdom_index = build_kingdom_index(speciesdata)
 
     #
     # get data
@@ -172,11 +221,20 @@ if __name__ == "__main__":
     retrieve_responses = True
     retrieve_kingdoms = True
 
+    # iNat taxon nodes shared by the response and kingdom phases
+    taxon_cache = TaxonNodeCache()
+
     # create coredata
     if create_coredata:
+        # when run incrementally, keep the records (and retrieved responses) of species whose inputs haven't changed
+        stale_keys = load_stale_keys()
+        previous_coredata = load_previous_output(tgt_table, stale_keys)
         # prepare coredata in desired format
         coredata = {str(i): {"scientific_name": key} for i, key in enumerate(species_dict.keys())}
         for key in coredata.keys():
+            if is_fresh(key, previous_coredata, stale_keys):
+                coredata[key] = previous_coredata[key]
+                continue
             scientific_name = coredata[key]["scientific_name"]
             keys_dict = species_dict[scientific_name][0]
             if keys_dict:
@@ -188,36 +246,45 @@ if __name__ == "__main__":
                     pass
 
         print(coredata["0"])
-
-        with open(tgtpath, 'w', encoding='utf-8') as json_file:
-            json.dump(coredata, json_file)
+    else:
+        coredata = species_store.read(tgt_table)
+
+    # finished species of an interrupted run, per phase
+    journal = RecordJournal(journalpath)
+    completed = journal.replay({key: record["scientific_name"] for key, record in coredata.items()})
+    # a species counts as done in a phase only if it is done in the phases before it
+    phases = ["inat", "responses", "kingdoms"]
+    for earlier, later in zip(phases, phases[1:]):
+        completed[later] = {key: entry for key, entry in completed.get(later, {}).items()
+                            if key in completed.get(earlier, {})}
+    if any(completed.values()):
+        print(f"resuming from {journalpath}: " + ", ".join(
+            f"{len(records)} species done in phase '{phase}'" for phase, records in completed.items()))
 
     # get inat keys
     if retrieve_inat:
-        with open(tgtpath, "r") as file:
-            coredata = json.load(file)
-        coredata = get_inat_keys(coredata)
-        print(f"saving dict with {len(coredata.keys())} entries to {tgtpath}...")
-        with open(tgtpath, 'w', encoding='utf-8') as json_file:
-            json.dump(coredata, json_file)
+        run_report.mark("inat_keys")
+        coredata = get_inat_keys(coredata, journal, completed.get("inat", {}))
+        journal.sync()
 
     # get gbif and inat responses
     if retrieve_responses:
-        with open(tgtpath, "r") as file:
-            coredata = json.load(file)
-        coredata = get_gbif_and_inat_data(coredata)
-        print(f"saving dict with {len(coredata.keys())} entries to {tgtpath}...")
-        with open(tgtpath, 'w', encoding='utf-8') as json_file:
-            json.dump(coredata, json_file)
+        run_report.mark("responses")
+        coredata = get_gbif_and_inat_data(coredata, taxon_cache, journal, completed.get("responses", {}))
+        journal.sync()
 
     # collect kingdoms
     if retrieve_kingdoms:
-        with open(tgtpath, "r") as file:
-            coredata = json.load(file)
-        coredata = get_kingdom(coredata, speciesdata)
-        print(f"saving dict with {len(coredata.keys())} entries to {tgtpath}...")
-        with open(tgtpath, 'w', encoding='utf-8') as json_file:
-            json.dump(coredata, json_file)
+        run_report.mark("kingdoms")
+        coredata = get_kingdom(coredata, kingdom_index, taxon_cache, journal, completed.get("kingdoms", {}))
+        journal.sync()
+
+    # compact the journal into the final output
+    run_report.mark("save")
+    print(f"saving dict with {len(coredata.keys())} entries to table {tgt_table}...")
+    species_store.write(tgt_table, coredata)
+    save_failed_keys(failed_keys)
+    journal.clear()
 
     """no_inat_key_found = []
     no_response_found = []
@@ -304,4 +371,6 @@ if __name__ == "__main__":
         json.dump(no_inat_key_found, json_file)
     with open("data/01_no_response.json", 'w') as json_file:
         json.dump(no_response_found, json_file)"""
+    response_cache.print_stats()
+    http_client.print_stats()
     print("done!")
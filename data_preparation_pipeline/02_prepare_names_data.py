@@ -8,15 +8,17 @@ from utils.wikidata_requests import (retrieve_inat_taxon_id_response, retrieve_g
                                      retrieve_inat_response)
 import pandas as pd
 from tqdm import tqdm
+from utils.species_store import species_store
+from utils.instrumentation import run_report
 
 
 #
 # paths
 #
 
-srcpath_coredata = "data/01_species_14991_coredata.json"
-srcpath_wikidata = "data/00_species_14991_wikidata.json"
-tgtpath = "data/02_species_14991_namesdata.json"
+src_table_coredata = "coredata"
+src_table_wikidata = "wikidata"
+tgt_table = "namesdata"
 
 
 #
@@ -25,13 +27,13 @@ tgtpath = "data/02_species_14991_namesdata.json"
 
 
 if __name__ == "__main__":
-    # Load the JSON file
-    with open(srcpath_coredata, "r") as file:
-        coredata = json.load(file)
-    with open(srcpath_wikidata, "r") as file:
-        wikidata = json.load(file)
+    run_report.mark("load")
+    # Load only the fields used here
+    coredata = species_store.read(src_table_coredata, ['scientific_name', 'gbif_vernacular_response', 'inat_results'])
+    wikidata = species_store.read(src_table_wikidata, ['eng.canonicalurl', 'mri.canonicalurl'])
 
     # prepare namesdata in desired format
+    run_report.mark("names")
     namesdata = {}
     num_wikipedia_links = 0
     num_common_names = 0
@@ -65,9 +67,9 @@ if __name__ == "__main__":
         }
 
     # save the results
+    run_report.mark("save")
     print(
-        f"saving dict with {len(namesdata.keys())} entries to {tgtpath}... found {num_wikipedia_links} wikipedia links and {num_common_names} inaturalist common names.")
-    with open(tgtpath, 'w') as json_file:
-        json.dump(namesdata, json_file)
+        f"saving dict with {len(namesdata.keys())} entries to table {tgt_table}... found {num_wikipedia_links} wikipedia links and {num_common_names} inaturalist common names.")
+    species_store.write(tgt_table, namesdata)
     print("done!")
 
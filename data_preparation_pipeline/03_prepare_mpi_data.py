@@ -2,13 +2,17 @@ import json
 from tqdm import tqdm
 import pandas as pd
 
+from utils.pest_matcher import PestRegisterIndex
+from utils.species_store import species_store
+from utils.instrumentation import run_report
+
 #
 # paths
 #
 
 srcpath_pestdata = "data/00_mpi_pest_register.csv"
-srcpath_coredata = "data/01_species_14991_coredata.json"
-tgtpath_mpidata = "data/03_species_14991_mpidata.json"
+srcpath_species = "data/collected_id.json"
+tgt_table_mpidata = "mpidata"
 
 
 # Function to aggregate strings
@@ -31,8 +35,10 @@ if __name__ == "__main__":
     #
     # load data
     #
-    with open(srcpath_coredata, "r") as file:
-        coredata = json.load(file)
+    run_report.mark("load")
+    # species keys and names are numbered as in stages 00 and 01, so this stage doesn't wait for 01
+    with open(srcpath_species, "r") as file:
+        coredata = {str(i): {"scientific_name": name} for i, name in enumerate(json.load(file).keys())}
     pest_df = pd.read_csv(srcpath_pestdata, delimiter=',')
 
     # drop common names
@@ -57,33 +63,35 @@ if __name__ == "__main__":
     print(pest_df["Unwanted"].unique())
     print(pest_df["Notifiable"].unique())
 
+    # find the register rows matching every species in one pass
+    run_report.mark("match")
+    species_names = {key: coredata[key]['scientific_name'].lower() for key in coredata.keys()}
+    matches = PestRegisterIndex(pest_df).match_all(species_names)
+    matches = pd.DataFrame(matches, columns=["species_key", "row"])
+    pest_matches = matches.join(pest_df.loc[:, ["Organism type", "Unwanted", "Notifiable"]], on="row")
+
+    # Aggregate unwanted and notifiable columns into alphabetically ordered comma-separated strings,
+    # per species and organism type; the first organism type (alphabetically) is used per species
+    pest_matches = pest_matches.groupby(["species_key", "Organism type"]).agg(
+        {"Unwanted": aggregate_strings, "Notifiable": aggregate_strings})
+    first_rows = pest_matches.groupby(level="species_key").head(1).reset_index(level="Organism type")
+
     num_matches = 0
     mpidata = {}
     for key in tqdm(coredata.keys()):
-        mpidata[key] = {}
-        scientific_name = coredata[key]['scientific_name']
-        pest_matches = pest_df[(pest_df["Pest name"] == scientific_name.lower()) | (
-            pest_df["Scientific name(s)"].str.contains(scientific_name.lower(), na=False))]
-        pest_matches = pest_matches.loc[:, ["Organism type", "Unwanted", "Notifiable"]]
-
-        # Aggregate unwanted and notifiable columns into alphabetically ordered comma-separated strings
-        pest_matches = pest_matches.groupby(["Organism type"]).agg(
-            {"Unwanted": aggregate_strings, "Notifiable": aggregate_strings})
-
-        if scientific_name == "Apis mellifera":  # check for common honey bee
-            print(pest_matches)
-        mpidata[key]['unwanted'] = ""
-        mpidata[key]['notifiable'] = ""
-        if not pest_matches.empty:
-            first_row = pest_matches.iloc[0]
+        if coredata[key]['scientific_name'] == "Apis mellifera":  # check for common honey bee
+            print(pest_matches.xs(key, level="species_key") if key in first_rows.index else "no register matches")
+        mpidata[key] = {'unwanted': "", 'notifiable': ""}
+        if key in first_rows.index:
+            first_row = first_rows.loc[key]
             mpidata[key]['unwanted'] = first_row["Unwanted"]
             mpidata[key]['notifiable'] = first_row["Notifiable"]
             num_matches += 1
 
     # save the results
+    run_report.mark("save")
     print(
-        f"saving dict with {len(mpidata.keys())} entries to {tgtpath_mpidata}... {num_matches} species matched.")
-    with open(tgtpath_mpidata, 'w') as json_file:
-        json.dump(mpidata, json_file)
+        f"saving dict with {len(mpidata.keys())} entries to table {tgt_table_mpidata}... {num_matches} species matched.")
+    species_store.write(tgt_table_mpidata, mpidata)
     print("done!")
 
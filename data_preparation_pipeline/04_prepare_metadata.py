@@ -1,19 +1,29 @@
 import json
 from os import sep
 from tqdm import tqdm
-import wikipediaapi
-import requests
 from utils.wikidata_requests import retrieve_gbif_vernacular_names, retrieve_inat_response
-from time import sleep
+from utils.response_cache import response_cache
+from utils.pipeline_state import load_stale_keys, load_previous_output, is_fresh, save_failed_keys
+from utils.species_store import species_store
+from utils.wikipedia_client import PooledWikipedia
+from utils.mediawiki import DeltaRefresher
+from utils.http_client import http_client
+from utils.instrumentation import run_report
+
+# re-download only the Wikipedia pages edited since they were harvested or last refreshed,
+# checking their current revisions in bulk; when False the harvested summaries are trusted as they are
+delta_refresh = True
 
 #
 # paths
 #
 
-srcpath_wikidata = "data/00_species_14991_wikidata.json"
-srcpath_coredata = "data/01_species_14991_coredata.json"
-srcpath_namesdata = "data/02_species_14991_namesdata.json"
-srcpath_mpidata = "data/03_species_14991_mpidata.json"
+src_table_wikidata = "wikidata"
+src_table_coredata = "coredata"
+src_table_namesdata = "namesdata"
+src_table_mpidata = "mpidata"
+tgt_table_metadata = "metadata"
+# app-facing export
 tgtpath_metadata = "data/04_species_14991_metadata.json"
 
 
@@ -57,10 +67,13 @@ def remove_references(summary):
     return cleaned_summary.strip()  # Remove leading/trailing whitespace
 
 
+def harvested_title(page: dict):
+    return page.get('title') if page else None
+
+
 def retrieve_wikipedia_summaries(page_name):
     mri_page_name = page_name
     eng_response = eng_wiki.page(page_name)
-    sleep(0.25)
     try:
         eng_summary = ""
         mri_summary = ""
@@ -72,7 +85,6 @@ def retrieve_wikipedia_summaries(page_name):
                 mri_page_name = lang_links['mi']
         # get mri name
         mri_response = mri_wiki.page(mri_page_name)
-        sleep(0.25)
         if mri_response.exists():
             mri_summary = mri_response.summary
         return eng_summary, mri_summary
@@ -104,24 +116,48 @@ if __name__ == "__main__":
     #
     # load data
     #
-    with open(srcpath_wikidata, "r") as file:
-        wikidata = json.load(file)
-    with open(srcpath_coredata, "r") as file:
-        coredata = json.load(file)
-    with open(srcpath_namesdata, "r") as file:
-        namesdata = json.load(file)
-    with open(srcpath_mpidata, "r") as file:
-        mpidata = json.load(file)
+    run_report.mark("load")
+    # only the summaries, urls and revisions of the harvested pages are needed, not their text, links and categories
+    wikidata = species_store.read(src_table_wikidata, ['eng.summary', 'eng.canonicalurl', 'eng.title', 'eng.lastrevid',
+                                                       'eng.langlinks', 'mri.summary', 'mri.title', 'mri.lastrevid'])
+    coredata = species_store.read(src_table_coredata, ['scientific_name', 'kingdom'])
+    namesdata = species_store.read(src_table_namesdata)
+    mpidata = species_store.read(src_table_mpidata)
+    # when run incrementally, keep the metadata of species whose inputs haven't changed
+    stale_keys = load_stale_keys()
+    previous_metadata = load_previous_output(tgt_table_metadata, stale_keys)
 
     #
     # prepare wikipedia api
     #
-    eng_wiki = wikipediaapi.Wikipedia('en')
-    mri_wiki = wikipediaapi.Wikipedia('mi')
+    eng_wiki = PooledWikipedia('en')
+    mri_wiki = PooledWikipedia('mi')
+
+    run_report.mark("revisions")
+    pending_keys = [key for key in coredata.keys() if not is_fresh(key, previous_metadata, stale_keys)]
+    if delta_refresh:
+        # look up the current revision of every page needed, 50 titles per request, before fetching any page
+        refresher = DeltaRefresher(eng_wiki, mri_wiki)
+        refresher.seed(wikidata)
+        page_names = []
+        for key in pending_keys:
+            link = namesdata[key]['eng']['wikipedia_url']
+            if wikidata[key]['eng'] and 'canonicalurl' in wikidata[key]['eng'] and \
+                    link != wikidata[key]['eng']['canonicalurl']:
+                page_names.append(link.split(sep)[-1])
+        print(f"checking revisions of the Wikipedia pages of {len(pending_keys)} species...")
+        refresher.prepare('en', [harvested_title(wikidata[key]['eng']) for key in pending_keys])
+        refresher.prepare('mi', [harvested_title(wikidata[key]['mri']) for key in pending_keys])
+        refresher.prepare_summaries(page_names)
 
     metadata = {}
     urls_updated = 0  # keep track of the number of times a wikipedia url had to be updated
+    failed_keys = set()  # species whose refreshed summaries couldn't be downloaded, recomputed on the next run
+    run_report.mark("metadata")
     for key in tqdm(coredata.keys()):
+        if is_fresh(key, previous_metadata, stale_keys):
+            metadata[key] = previous_metadata[key]
+            continue
         metadata[key] = {
             "scientific_name": coredata[key]['scientific_name'],
             "preferred_common_name": namesdata[key]['preferred_common_name'],
@@ -139,6 +175,17 @@ if __name__ == "__main__":
             "notifiable": mpidata[key]['notifiable'],
             "kingdom": coredata[key]['kingdom']
         }
+        if delta_refresh:
+            # harvested summaries, re-downloaded if their page was edited since
+            for lang, language in (('eng', 'en'), ('mri', 'mi')):
+                title = harvested_title(wikidata[key][lang])
+                if title:
+                    try:
+                        metadata[key][lang]['wikipedia_summary'] = refresher.summary(language, title)[0]
+                    # keep the harvested summary if the page can't be downloaded
+                    except Exception as e:
+                        print(f"error refreshing {language} page '{title}': {e}")
+                        failed_keys.add(key)
 
         #
         # collect names lists and merge them
@@ -177,20 +224,36 @@ if __name__ == "__main__":
         if wikidata[key]['eng'] and 'canonicalurl' in wikidata[key]['eng']:
             if metadata[key]['eng']['wikipedia_link'] != wikidata[key]['eng']['canonicalurl']:
                 page_name = metadata[key]['eng']['wikipedia_link'].split(sep)[-1]
-                eng_summary, mri_summary = retrieve_wikipedia_summaries(page_name)
-                metadata[key]['eng']['wikipedia_summary'] = eng_summary
-                metadata[key]['mri']['wikipedia_summary'] = mri_summary
-                urls_updated += 1
+                if delta_refresh:
+                    try:
+                        eng_summary, mri_summary = refresher.summaries(page_name)
+                    # keep the harvested summaries if the linked page can't be downloaded
+                    except Exception as e:
+                        print(f"error handling name '{page_name}': {e}")
+                        failed_keys.add(key)
+                        eng_summary, mri_summary = None, None
+                else:
+                    eng_summary, mri_summary = retrieve_wikipedia_summaries(page_name)
+                if eng_summary is not None:
+                    metadata[key]['eng']['wikipedia_summary'] = eng_summary
+                    metadata[key]['mri']['wikipedia_summary'] = mri_summary
+                    urls_updated += 1
 
         # clean up summaries
         metadata[key]['eng']['wikipedia_summary'] = remove_references(metadata[key]['eng']['wikipedia_summary'])
         metadata[key]['mri']['wikipedia_summary'] = remove_references(metadata[key]['mri']['wikipedia_summary'])
 
     # save the results
+    run_report.mark("save")
     print(
         f"saving dict with {len(metadata.keys())} entries to {tgtpath_metadata}... {urls_updated} Wikipedia urls "
         f"and summaries updated.")
-    with open(tgtpath_metadata, 'w') as json_file:
-        json.dump(metadata, json_file)
+    if delta_refresh:
+        print(f"{refresher.reused} Wikipedia pages reused, {refresher.downloaded} re-downloaded.")
+    species_store.write(tgt_table_metadata, metadata)
+    species_store.export_json(tgt_table_metadata, tgtpath_metadata)
+    save_failed_keys(failed_keys)
+    response_cache.print_stats()
+    http_client.print_stats()
     print("done!")
 
@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+from mock_api_server import FaultProfile, make_server
+
+#
+# offline benchmark of stages 00-04
+#
+# --record runs the pipeline against the live APIs once and stores every response as a fixture;
+# without it the pipeline runs against mock_api_server.py replaying those fixtures with the given faults.
+# Every run happens in a scratch copy of the pipeline directory, so data/ and its caches are left alone.
+#
+
+pipeline_dir = os.path.dirname(os.path.abspath(__file__))
+path_species = os.path.join(pipeline_dir, "data", "collected_id.json")
+path_pestdata = os.path.join(pipeline_dir, "data", "00_mpi_pest_register.csv")
+path_speciesdata = os.path.join(pipeline_dir, "..", "data", "NZ-Species.csv")
+# stages in an order that respects their dependencies
+STAGE_ORDER = ["00", "01", "03", "02", "04"]
+
+
+def prepare_workdir(num_species):
+    # scratch pipeline directory: the scripts and utils linked in, fresh data/ with the first num_species species
+    workdir = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    pipeline = os.path.join(workdir, "pipeline")
+    os.makedirs(os.path.join(pipeline, "data"))
+    os.makedirs(os.path.join(workdir, "data"))
+    for name in os.listdir(pipeline_dir):
+        if name.endswith(".py") or name == "utils":
+            os.symlink(os.path.join(pipeline_dir, name), os.path.join(pipeline, name))
+    os.symlink(path_pestdata, os.path.join(pipeline, "data", os.path.basename(path_pestdata)))
+    os.symlink(os.path.abspath(path_speciesdata), os.path.join(workdir, "data", "NZ-Species.csv"))
+    with open(path_species, "r") as file:
+        species = json.load(file)
+    if num_species:
+        species = dict(list(species.items())[:num_species])
+    with open(os.path.join(pipeline, "data", "collected_id.json"), "w") as file:
+        json.dump(species, file)
+    return workdir, pipeline, len(species)
+
+
+def run_benchmark(args):
+    workdir, pipeline, num_species = prepare_workdir(args.species)
+    environment = dict(os.environ)
+    for variable in ("HTTP_RECORD_PATH", "HTTP_REPLAY_URL", "RESPONSE_CACHE_ONLY", "SPECIES_STORE_PATH",
+                     "RESPONSE_CACHE_PATH"):
+        environment.pop(variable, None)
+    server = None
+    if args.record:
+        environment["HTTP_RECORD_PATH"] = os.path.abspath(args.fixtures)
+    else:
+        faults = FaultProfile(args.latency, args.jitter, args.recorded_latency, args.error_rate, args.burst_every,
+                              args.burst_length, args.retry_after, args.seed)
+        server = make_server(os.path.abspath(args.fixtures), 0, faults)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        environment["HTTP_REPLAY_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+
+    results = {"mode": "record" if args.record else "replay", "species": num_species, "faults": vars(args),
+               "stages": {}}
+    started = perf_counter()
+    for stage in STAGE_ORDER:
+        stats_path = os.path.join(workdir, f"http_{stage}.json")
+        environment["HTTP_STATS_PATH"] = stats_path
+        print(f"[{stage}] running...", flush=True)
+        stage_started = perf_counter()
+        result = subprocess.run([sys.executable, "run_pipeline.py", "--force", stage], cwd=pipeline,
+                                env=environment, stdout=subprocess.DEVNULL)
+        seconds = perf_counter() - stage_started
+        http = {}
+        if os.path.exists(stats_path):
+            with open(stats_path, "r") as file:
+                http = json.load(file)
+        requests = sum(counts.get("requests", 0) for counts in http.values())
+        results["stages"][stage] = {"seconds": round(seconds, 2), "returncode": result.returncode, "http": http}
+        print(f"[{stage}] {'ok' if result.returncode == 0 else 'failed'} in {seconds:.1f}s, {requests} requests",
+              flush=True)
+        if result.returncode != 0:
+            shutil.copy(os.path.join(pipeline, "data", f"{stage}_run.log"), f"{args.output}.{stage}.log")
+            print(f"[{stage}] log copied to {args.output}.{stage}.log; later stages skipped", flush=True)
+            break
+    results["seconds"] = round(perf_counter() - started, 2)
+    if server is not None:
+        results["server"] = server.stats_report()
+        server.shutdown()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"total {results['seconds']}s, results saved to {args.output}")
+    if args.keep:
+        print(f"scratch directory kept at {workdir}")
+    else:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time stages 00-04 against recorded API responses")
+    parser.add_argument("--record", action="store_true", help="record fixtures from the live APIs instead")
+    parser.add_argument("--fixtures", default="data/fixtures/responses.sqlite")
+    parser.add_argument("--species", type=int, default=200, help="number of species to run (0: all)")
+    parser.add_argument("--output", default="data/benchmark_results.json")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform +/- seconds added to the latency")
+    parser.add_argument("--recorded-latency", action="store_true", help="use the latency of the recorded responses")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--burst-every", type=int, default=0, help="requests per host between two 429 bursts")
+    parser.add_argument("--burst-length", type=int, default=0, help="requests per host answered with 429 per burst")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--seed", type=int, default=0)
+    run_benchmark(parser.parse_args())
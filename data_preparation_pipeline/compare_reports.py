@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+
+#
+# compare the run reports of two pipeline runs, e.g. data/reports/20240101-120000 and data/reports/20240108-120000
+#
+
+
+def load_reports(directory):
+    reports = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name), "r") as file:
+                reports[name[:-len(".json")]] = json.load(file)
+    return reports
+
+
+def summarise(report):
+    # the headline numbers of one script's report
+    http = report.get("http", {}).values()
+    cache = report.get("cache", {}).values()
+    return {
+        "wall s": report["wall_seconds"],
+        "cpu s": report["cpu_seconds"],
+        "sleep s": round(sum(host.get("sleep_seconds", 0) for host in http), 1),
+        "backoff s": round(sum(host.get("backoff_seconds", 0) for host in http), 1),
+        "requests": sum(host.get("requests", 0) for host in http),
+        "retries": sum(host.get("retries", 0) for host in http),
+        "cache hits": sum(counts["hits"] for counts in cache),
+        "peak MB": report.get("peak_rss_mb"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare the run reports of two pipeline runs")
+    parser.add_argument("before", help="report directory of the first run")
+    parser.add_argument("after", help="report directory of the second run")
+    args = parser.parse_args()
+
+    before, after = load_reports(args.before), load_reports(args.after)
+    for script in sorted(set(before) | set(after)):
+        print(script)
+        if script not in before or script not in after:
+            print(f"  only in {args.before if script in before else args.after}")
+            continue
+        old, new = summarise(before[script]), summarise(after[script])
+        for metric in old:
+            print(f"  {metric:<11}{str(old[metric]):>12} -> {str(new[metric]):<12}")
+        for phase, timing in after[script].get("phases", {}).items():
+            old_phase = before[script].get("phases", {}).get(phase, {}).get("seconds")
+            print(f"  {phase + ' s':<11}{str(old_phase):>12} -> {timing['seconds']:<12}")
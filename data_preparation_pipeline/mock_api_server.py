@@ -0,0 +1,144 @@
+import argparse
+import json
+import random
+import threading
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+from utils.fixtures import FixtureStore, fixture_key
+
+#
+# local stand-in for Wikidata, GBIF, iNaturalist and Wikipedia
+#
+# replays responses recorded with HTTP_RECORD_PATH; the pipeline is pointed at it with
+# HTTP_REPLAY_URL=http://127.0.0.1:<port>, and requests arrive as /<original host>/<original path>?<query>
+#
+
+
+class FaultProfile:
+    # latency, random server errors and periodic 429 bursts, per original host
+    def __init__(self, latency=0.0, jitter=0.0, recorded_latency=False, error_rate=0.0, burst_every=0,
+                 burst_length=0, retry_after=1.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.recorded_latency = recorded_latency
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+    def fault(self, host: str):
+        # returns the status to answer with instead of the fixture, or None
+        with self._lock:
+            count = self.requests[host]
+            self.requests[host] += 1
+            if self.burst_every and count % self.burst_every >= self.burst_every - self.burst_length:
+                return 429
+            if self.random.random() < self.error_rate:
+                return 503
+        return None
+
+    def delay(self, recorded: float):
+        with self._lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+        return max(0.0, (recorded if self.recorded_latency and recorded else self.latency) + jitter)
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, content_type: str, body: bytes, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply(self):
+        server = self.server
+        if self.path == "/__stats":
+            self._send(200, "application/json", json.dumps(server.stats_report()).encode("utf-8"))
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        host = self.path.lstrip("/").split("/", 1)[0]
+        url = "https://" + self.path.lstrip("/")
+        with server.lock:
+            server.stats[host]["requests"] += 1
+        status = server.faults.fault(host)
+        if status is not None:
+            with server.lock:
+                server.stats[host]["injected_" + str(status)] += 1
+            headers = {"Retry-After": str(server.faults.retry_after)} if status == 429 else {}
+            self._send(status, "text/plain", b"injected fault", headers)
+            return
+        fixture = server.fixtures.lookup(fixture_key(self.command, url, body))
+        if fixture is None:
+            with server.lock:
+                server.stats[host]["misses"] += 1
+            self._send(404, "application/json", json.dumps({"error": "no fixture for " + url}).encode("utf-8"))
+            return
+        status, content_type, payload, recorded = fixture
+        sleep(server.faults.delay(recorded))
+        with server.lock:
+            server.stats[host]["replayed"] += 1
+        self._send(status, content_type or "application/json", bytes(payload or b""))
+
+    def do_GET(self):
+        self._reply()
+
+    def do_POST(self):
+        self._reply()
+
+
+class MockApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fixtures: FixtureStore, faults: FaultProfile):
+        super().__init__(address, MockApiHandler)
+        self.fixtures = fixtures
+        self.faults = faults
+        # per original host: requests, replayed, misses and injected faults
+        self.stats = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def stats_report(self):
+        with self.lock:
+            return {host: dict(counts) for host, counts in self.stats.items()}
+
+
+def make_server(fixtures_path: str, port: int, faults: FaultProfile):
+    return MockApiServer(("127.0.0.1", port), FixtureStore(fixtures_path), faults)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay recorded API responses with configurable faults")
+    parser.add_argument("--fixtures", default="data/fixtures/responses.sqlite", help="fixture database to replay")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform +/- seconds added to the latency")
+    parser.add_argument("--recorded-latency", action="store_true", help="use the latency of the recorded responses")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--burst-every", type=int, default=0, help="requests per host between two 429 bursts")
+    parser.add_argument("--burst-length", type=int, default=0, help="requests per host answered with 429 per burst")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    faults = FaultProfile(args.latency, args.jitter, args.recorded_latency, args.error_rate, args.burst_every,
+                          args.burst_length, args.retry_after, args.seed)
+    server = make_server(args.fixtures, args.port, faults)
+    print(f"replaying {server.fixtures.count()} fixtures from {args.fixtures} on port {args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
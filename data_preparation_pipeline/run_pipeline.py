@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils.instrumentation import run_id, run_report
+from utils.pipeline_state import FAILED_KEYS_ENV, STALE_KEYS_ENV
+from utils.species_store import species_store
+
+#
+# paths
+#
+
+statepath = "data/pipeline_state.json"
+path_species = "data/collected_id.json"
+path_speciesdata = "../data/NZ-Species.csv"
+# the GBIF export loader shared with the training scripts, loaded by utils/gbif_export.py
+path_gbif_export = "../data_training_validation/gbif_export.py"
+path_pestdata = "data/00_mpi_pest_register.csv"
+path_metadata = "data/04_species_14991_metadata.json"
+
+
+#
+# per-species inputs of each stage
+#
+
+
+def load_json(path):
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def species_records():
+    # species keys are numbered in the order of collected_id.json, as in every stage
+    species_dict = load_json(path_species)
+    return {str(i): [name, species_dict[name]] for i, name in enumerate(species_dict.keys())}
+
+
+def joined_records(*tables):
+    # one record per species holding its entry from every given stage table
+    outputs = [species_store.read(table) for table in tables]
+    return {key: [output.get(key) for output in outputs] for key in outputs[0].keys()}
+
+
+# each stage: script, upstream stages, files every species depends on, output tables (and files),
+# loader of the per-species inputs, and whether the script can recompute only stale species
+STAGES = {
+    "00": {
+        "script": "00_prepare_wikidata.py",
+        "depends": [],
+        "global_inputs": [],
+        "outputs": ["wikidata"],
+        "records": lambda: {key: record[0] for key, record in species_records().items()},
+        "incremental": True,
+    },
+    "01": {
+        "script": "01_retrieve_coredata.py",
+        "depends": [],
+        "global_inputs": [path_speciesdata, path_gbif_export],
+        "outputs": ["coredata"],
+        "records": species_records,
+        "incremental": True,
+    },
+    "02": {
+        "script": "02_prepare_names_data.py",
+        "depends": ["00", "01"],
+        "global_inputs": [],
+        "outputs": ["namesdata"],
+        "records": lambda: joined_records("coredata", "wikidata"),
+        "incremental": False,
+    },
+    "03": {
+        "script": "03_prepare_mpi_data.py",
+        "depends": [],
+        "global_inputs": [path_pestdata],
+        "outputs": ["mpidata"],
+        "records": lambda: {key: record[0] for key, record in species_records().items()},
+        "incremental": False,
+    },
+    "04": {
+        "script": "04_prepare_metadata.py",
+        "depends": ["00", "01", "02", "03"],
+        "global_inputs": [],
+        "outputs": ["metadata", path_metadata],
+        "records": lambda: joined_records("coredata", "wikidata", "namesdata", "mpidata"),
+        "incremental": True,
+    },
+}
+
+
+#
+# content hashing
+#
+
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_record(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def global_hash(stage):
+    # the script, the shared utils and any whole-file inputs; a change here makes every species stale
+    paths = [STAGES[stage]["script"]] + sorted(os.path.join("utils", f) for f in os.listdir("utils")
+                                               if f.endswith(".py")) + STAGES[stage]["global_inputs"]
+    return hash_record([[path, hash_file(path)] for path in paths])
+
+
+def find_stale(stage, state, force=False):
+    # returns (global hash, per-species hashes, stale species keys)
+    # species whose requests failed in the previous run are stale whatever their inputs
+    stage_global = global_hash(stage)
+    records = {key: hash_record(record) for key, record in STAGES[stage]["records"]().items()}
+    previous = state.get(stage, {})
+    outputs_exist = all(os.path.exists(output) if output.endswith(".json") else species_store.has_table(output)
+                        for output in STAGES[stage]["outputs"])
+    if force or not outputs_exist or previous.get("global") != stage_global \
+            or set(previous.get("records", {})) != set(records):
+        return stage_global, records, sorted(records)
+    failed = set(previous.get("failed", []))
+    stale = sorted(key for key, record_hash in records.items()
+                   if previous["records"][key] != record_hash or key in failed)
+    return stage_global, records, stale
+
+
+#
+# stage execution
+#
+
+
+def run_stage(stage, stale_keys, num_species):
+    # returns the return code of the script and the keys of the species whose requests failed
+    environment = dict(os.environ)
+    # the stages write their run reports next to this one
+    environment["RUN_ID"] = run_id
+    if STAGES[stage]["incremental"] and len(stale_keys) < num_species:
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+            json.dump(stale_keys, file)
+        environment[STALE_KEYS_ENV] = file.name
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+        environment[FAILED_KEYS_ENV] = file.name
+    print(f"[{stage}] running {STAGES[stage]['script']} for {len(stale_keys)}/{num_species} species...", flush=True)
+    with open(f"data/{stage}_run.log", "w") as log_file:
+        started = perf_counter()
+        result = subprocess.run([sys.executable, STAGES[stage]["script"]], env=environment,
+                                stdout=log_file, stderr=subprocess.STDOUT)
+    if STALE_KEYS_ENV in environment:
+        os.remove(environment[STALE_KEYS_ENV])
+    with open(environment[FAILED_KEYS_ENV], "r") as file:
+        content = file.read()
+    os.remove(environment[FAILED_KEYS_ENV])
+    failed_keys = json.loads(content) if content else []
+    run_report.details.setdefault("stages", {})[stage] = {
+        "seconds": round(perf_counter() - started, 3), "stale_species": len(stale_keys),
+        "species": num_species, "failed_species": len(failed_keys), "returncode": result.returncode}
+    return result.returncode, failed_keys
+
+
+def save_state(state):
+    with open(statepath, "w") as json_file:
+        json.dump(state, json_file)
+
+
+def run_pipeline(stages, force=False, jobs=3):
+    state = load_json(statepath) if os.path.exists(statepath) else {}
+    # stages not selected count as already done
+    done = {stage for stage in STAGES if stage not in stages}
+    failed = set()
+    running = {}
+    # hashes of running stages, committed to the state once they succeed
+    pending = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            # start every stage whose upstream stages have all finished
+            for stage in stages:
+                if stage in done or stage in failed or stage in running.values():
+                    continue
+                if any(dependency in failed for dependency in STAGES[stage]["depends"]):
+                    print(f"[{stage}] skipped, an upstream stage failed", flush=True)
+                    failed.add(stage)
+                    continue
+                if not all(dependency in done for dependency in STAGES[stage]["depends"]):
+                    continue
+                stage_global, records, stale = find_stale(stage, state, force)
+                if not stale:
+                    print(f"[{stage}] up to date", flush=True)
+                    done.add(stage)
+                    continue
+                future = executor.submit(run_stage, stage, stale, len(records))
+                running[future] = stage
+                pending[stage] = {"global": stage_global, "records": records}
+            if not running:
+                if all(stage in done or stage in failed for stage in stages):
+                    break
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                returncode, failed_keys = future.result()
+                if returncode == 0:
+                    state[stage] = dict(pending.pop(stage), failed=failed_keys)
+                    if failed_keys:
+                        print(f"[{stage}] requests failed for {len(failed_keys)} species, "
+                              f"they are retried on the next run", flush=True)
+                    save_state(state)
+                    print(f"[{stage}] done", flush=True)
+                    done.add(stage)
+                else:
+                    pending.pop(stage)
+                    print(f"[{stage}] failed, see data/{stage}_run.log", flush=True)
+                    failed.add(stage)
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run the data preparation stages, recomputing only stale work")
+    parser.add_argument("stages", nargs="*", default=sorted(STAGES), help="stages to run (default: all)")
+    parser.add_argument("--force", action="store_true", help="recompute every species of the selected stages")
+    parser.add_argument("--jobs", type=int, default=3, help="number of stages run concurrently")
+    args = parser.parse_args()
+    unknown = [stage for stage in args.stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages {', '.join(unknown)}, choose from {', '.join(sorted(STAGES))}")
+    sys.exit(0 if run_pipeline(args.stages, args.force, args.jobs) else 1)
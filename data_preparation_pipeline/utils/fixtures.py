@@ -0,0 +1,66 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# record every response the pipeline receives into this fixture database
+record_path = os.environ.get("HTTP_RECORD_PATH")
+# send every request to this mock server instead, e.g. http://127.0.0.1:8765 (see mock_api_server.py)
+replay_url = os.environ.get("HTTP_REPLAY_URL")
+
+
+def canonical_url(url: str):
+    # scheme-less url with sorted query parameters, so equal requests map to the same fixture
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return parts.netloc + parts.path + ("?" + query if query else "")
+
+
+def fixture_key(method: str, url: str, body=None):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    digest = hashlib.sha1(f"{method.upper()} {canonical_url(url)}\n".encode("utf-8"))
+    digest.update(body or b"")
+    return digest.hexdigest()
+
+
+def replay_target(url: str):
+    # the mock server receives the original host as the first path segment
+    parts = urlsplit(url)
+    target = replay_url.rstrip("/") + "/" + parts.netloc + parts.path
+    return target + ("?" + parts.query if parts.query else "")
+
+
+class FixtureStore:
+    # recorded responses keyed by method, url and body
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS fixtures (key TEXT PRIMARY KEY, method TEXT, url TEXT, status INTEGER, "
+            "content_type TEXT, body BLOB, elapsed REAL)")
+        self._lock = threading.Lock()
+
+    def record(self, response):
+        # stores the response the client ended up with; a later identical request replaces it
+        request = response.request
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO fixtures VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (fixture_key(request.method, request.url, request.body), request.method, request.url,
+                 response.status_code, response.headers.get("Content-Type", ""), response.content,
+                 response.elapsed.total_seconds()))
+            self.connection.commit()
+
+    def lookup(self, key: str):
+        # (status, content type, body, recorded latency) or None
+        with self._lock:
+            return self.connection.execute("SELECT status, content_type, body, elapsed FROM fixtures WHERE key = ?",
+                                           (key,)).fetchone()
+
+    def count(self):
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM fixtures").fetchone()[0]
@@ -0,0 +1,25 @@
+import importlib.util
+import os
+import sys
+
+# the loader of the GBIF export is shared with the training scripts; it lives in data_training_validation/gbif_export.py
+# and is loaded from there by path, so that both sides read and write the same Parquet cache
+shared_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                           "data_training_validation", "gbif_export.py")
+
+_spec = importlib.util.spec_from_file_location("gbif_export", shared_path)
+gbif_export = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(gbif_export)
+
+COLUMNS = gbif_export.COLUMNS
+SCHEMA_VERSION = gbif_export.SCHEMA_VERSION
+cache_path = gbif_export.cache_path
+cache_is_current = gbif_export.cache_is_current
+convert = gbif_export.convert
+load_gbif_export = gbif_export.load_gbif_export
+load_gbif_index = gbif_export.load_gbif_index
+
+# convert the export ahead of time: python -m utils.gbif_export ../data/NZ-Species.csv
+if __name__ == "__main__":
+    converted = convert(sys.argv[1] if len(sys.argv) > 1 else "../data/NZ-Species.csv")
+    print(f"{len(converted)} rows, columns {list(converted.columns)}")
@@ -0,0 +1,228 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import re
+from collections import Counter, defaultdict
+from email.utils import parsedate_to_datetime
+from time import monotonic, perf_counter, sleep, time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.fixtures import FixtureStore, record_path, replay_target, replay_url
+from utils.instrumentation import LatencyHistogram
+from utils.rate_limit import TokenBucket
+
+USER_AGENT = "aotearoa-species-classifier data pipeline (https://github.com/Waikato/aotearoa-species-classifier)"
+# connections kept alive per host
+POOL_SIZE = 32
+DEFAULT_TIMEOUT = 60
+MAX_RETRIES = 8
+# first backoff after an error without a Retry-After header, doubled on every further attempt
+BACKOFF = 2.0
+
+# per host: (initial, minimum, maximum) requests per second
+HOST_LIMITS = {
+    "query.wikidata.org": (1.0, 0.1, 5.0),
+    "api.gbif.org": (2.0, 0.2, 20.0),
+    "api.inaturalist.org": (1.0, 0.1, 1.5),
+    "en.wikipedia.org": (5.0, 0.5, 50.0),
+    "mi.wikipedia.org": (5.0, 0.5, 50.0),
+}
+DEFAULT_LIMITS = (1.0, 0.1, 10.0)
+# numeric ids (and comma-separated lists of them) in a path, grouped into one endpoint for the latency stats
+ID_PATTERN = re.compile(r"\d+(,\d+)*")
+# additive increase per successful request, multiplicative decrease per throttled one
+RATE_INCREASE = 0.05
+RATE_DECREASE = 0.5
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AimdRateController(TokenBucket):
+    # token bucket whose rate follows additive-increase/multiplicative-decrease on the server's responses
+    def __init__(self, rate: float, min_rate: float, max_rate: float):
+        super().__init__(rate, capacity=1.0)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.blocked_until = 0.0
+        # time spent in backoff pauses, as opposed to waiting for tokens
+        self.paused = 0.0
+
+    def acquire(self, tokens: float = 1.0):
+        waited = 0.0
+        with self._lock:
+            pause = self.blocked_until - monotonic()
+        if pause > 0:
+            sleep(pause)
+            waited += pause
+            with self._lock:
+                self.paused += pause
+        return waited + super().acquire(tokens)
+
+    def on_success(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def on_throttle(self, pause: float):
+        # slow down, and hold every request to this host for the given pause
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+            self.blocked_until = max(self.blocked_until, monotonic() + pause)
+
+
+class HostState:
+    def __init__(self, host: str):
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.controller = AimdRateController(*HOST_LIMITS.get(host, DEFAULT_LIMITS))
+        self.stats = Counter()
+        self.started = None
+        # request latency per endpoint path
+        self.latency = defaultdict(LatencyHistogram)
+        self.lock = threading.Lock()
+
+    def count(self, name: str, amount=1):
+        # counters are updated by every worker thread of the host
+        with self.lock:
+            self.stats[name] += amount
+            if self.started is None:
+                self.started = monotonic()
+
+    def add_latency(self, url: str, seconds: float):
+        endpoint = ID_PATTERN.sub("{id}", urlsplit(url).path)
+        with self.lock:
+            self.latency[endpoint].add(seconds)
+
+
+class HttpClient:
+    # shared HTTP client: one pooled session and one adaptive rate controller per host
+    def __init__(self):
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self.recorder = FixtureStore(record_path) if record_path else None
+
+    def _host(self, host: str):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostState(host)
+            return self._hosts[host]
+
+    def request(self, method: str, url: str, retry_timeouts: bool = True, is_final=None, **kwargs):
+        # sends a request, retrying 429/5xx responses and connection errors with backoff that honours Retry-After
+        # is_final(response) may mark error responses that retrying can't fix; they are returned immediately
+        # the last response is returned whatever its status; connection errors are raised after the last attempt
+        host = urlsplit(url).netloc
+        state = self._host(host)
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        # rate control stays per original host when replaying, so retry behaviour matches a live run
+        target = replay_target(url) if replay_url else url
+        for attempt in range(MAX_RETRIES + 1):
+            state.count("sleep_seconds", state.controller.acquire())
+            state.count("requests")
+            if attempt:
+                state.count("retries")
+            backoff = BACKOFF * 2 ** attempt
+            sent = perf_counter()
+            try:
+                response = state.session.request(method, target, **kwargs)
+            except requests.exceptions.Timeout:
+                state.add_latency(url, perf_counter() - sent)
+                state.count("timeouts")
+                if not retry_timeouts or attempt == MAX_RETRIES:
+                    raise
+                state.controller.on_throttle(backoff)
+                continue
+            except requests.exceptions.ConnectionError:
+                state.add_latency(url, perf_counter() - sent)
+                state.count("connection_errors")
+                if attempt == MAX_RETRIES:
+                    raise
+                state.controller.on_throttle(backoff)
+                continue
+            state.add_latency(url, perf_counter() - sent)
+            if response.status_code == 429 or response.status_code >= 500:
+                state.count("throttled" if response.status_code == 429 else "server_errors")
+                if (is_final and is_final(response)) or attempt == MAX_RETRIES:
+                    return self._finish(response)
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                state.controller.on_throttle(retry_after if retry_after is not None else backoff)
+                continue
+            state.count("successes")
+            state.controller.on_success()
+            return self._finish(response)
+
+    def _finish(self, response):
+        if self.recorder is not None:
+            self.recorder.record(response)
+        return response
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        # live per-host counters, current rate and achieved throughput
+        # sleep_seconds is all time spent waiting before requests, backoff_seconds the part of it spent in backoff
+        with self._lock:
+            hosts = dict(self._hosts)
+        report = {}
+        for host, state in hosts.items():
+            with state.lock:
+                elapsed = monotonic() - state.started if state.started else 0.0
+                report[host] = dict(state.stats)
+                report[host]["endpoints"] = {endpoint: histogram.report()
+                                             for endpoint, histogram in state.latency.items()}
+            report[host]["backoff_seconds"] = round(state.controller.paused, 3)
+            report[host]["rate"] = round(state.controller.rate, 3)
+            report[host]["throughput"] = round(report[host].get("successes", 0) / elapsed, 3) if elapsed else 0.0
+        return report
+
+    def print_stats(self, file=sys.stdout):
+        for host, counts in self.stats().items():
+            print(f"{host}: {counts.get('successes', 0)}/{counts.get('requests', 0)} requests ok, "
+                  f"{counts.get('throttled', 0)} throttled, {counts.get('server_errors', 0)} server errors, "
+                  f"{counts.get('retries', 0)} retries, rate {counts['rate']}/s, "
+                  f"throughput {counts['throughput']}/s", file=file, flush=True)
+
+    def start_reporter(self, interval: float):
+        # print the stats every interval seconds from a background thread
+        def report():
+            while True:
+                sleep(interval)
+                self.print_stats(file=sys.stderr)
+        threading.Thread(target=report, daemon=True).start()
+
+    def save_stats(self, path: str):
+        with open(path, "w") as json_file:
+            json.dump(self.stats(), json_file)
+
+
+http_client = HttpClient()
+if os.environ.get("HTTP_STATS_INTERVAL"):
+    http_client.start_reporter(float(os.environ["HTTP_STATS_INTERVAL"]))
+# machine-readable stats of the whole process, used by benchmark_pipeline.py
+if os.environ.get("HTTP_STATS_PATH"):
+    atexit.register(http_client.save_stats, os.environ["HTTP_STATS_PATH"])
@@ -0,0 +1,130 @@
+import atexit
+import json
+import os
+import sys
+import threading
+from collections import defaultdict
+from datetime import datetime
+from functools import wraps
+from time import perf_counter, process_time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# reports are written to <report dir>/<run id>/<script>.json; run_pipeline.py sets one run id for all stages
+report_dir = os.environ.get("RUN_REPORT_DIR", "data/reports")
+run_id = os.environ.get("RUN_ID") or datetime.now().strftime("%Y%m%d-%H%M%S")
+# RUN_REPORT=0 disables the report
+enabled = os.environ.get("RUN_REPORT", "1") == "1"
+
+# upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+
+    def add(self, seconds: float):
+        index = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        self.counts[index] += 1
+        self.total += seconds
+
+    def report(self):
+        count = sum(self.counts)
+        buckets = {f"<={bound}": n for bound, n in zip(LATENCY_BUCKETS, self.counts)}
+        buckets[f">{LATENCY_BUCKETS[-1]}"] = self.counts[-1]
+        return {"requests": count, "seconds": round(self.total, 3),
+                "mean": round(self.total / count, 3) if count else 0.0, "histogram": buckets}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 ** 2 if sys.platform == "darwin" else 1024), 1)
+
+
+class RunReport:
+    # wall and cpu time per phase of a stage script, time per instrumented function and peak memory;
+    # request, sleep/backoff and cache counters are collected from the http client and response cache
+    def __init__(self):
+        self.script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "interactive"
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self._wall = perf_counter()
+        self._cpu = process_time()
+        self.phases = {}
+        self._phase = None
+        self.functions = defaultdict(lambda: {"calls": 0, "errors": 0, "seconds": 0.0})
+        # further script-specific entries of the report
+        self.details = {}
+        self._lock = threading.Lock()
+
+    def mark(self, phase: str):
+        # ends the current phase and starts the next one
+        now, cpu = perf_counter(), process_time()
+        if self._phase is not None:
+            name, wall_start, cpu_start = self._phase
+            self.phases[name] = {"seconds": round(now - wall_start, 3), "cpu_seconds": round(cpu - cpu_start, 3)}
+        self._phase = (phase, now, cpu) if phase else None
+
+    def add_call(self, name: str, seconds: float, failed: bool):
+        with self._lock:
+            self.functions[name]["calls"] += 1
+            self.functions[name]["errors"] += failed
+            self.functions[name]["seconds"] += seconds
+
+    def report(self):
+        self.mark(None)
+        report = {
+            "script": self.script,
+            "run_id": run_id,
+            "started": self.started,
+            "wall_seconds": round(perf_counter() - self._wall, 3),
+            "cpu_seconds": round(process_time() - self._cpu, 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "phases": self.phases,
+            "functions": {name: dict(counts, seconds=round(counts["seconds"], 3))
+                          for name, counts in self.functions.items()},
+        }
+        report.update(self.details)
+        # only report on the network modules the script actually used
+        if "utils.http_client" in sys.modules:
+            report["http"] = sys.modules["utils.http_client"].http_client.stats()
+        if "utils.response_cache" in sys.modules:
+            report["cache"] = sys.modules["utils.response_cache"].response_cache.stats()
+        return report
+
+    def save(self):
+        directory = os.path.join(report_dir, run_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.script}.json")
+        with open(path, "w") as json_file:
+            json.dump(self.report(), json_file, indent=2)
+        return path
+
+
+run_report = RunReport()
+if enabled:
+    atexit.register(run_report.save)
+
+
+def timed(name: str):
+    # count the calls of a function and the time spent in them, cache hits included
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                run_report.add_call(name, perf_counter() - started, failed)
+        return wrapper
+    return decorator
@@ -0,0 +1,64 @@
+import json
+import os
+
+
+class RecordJournal:
+    # append-only JSONL journal of finished species, one line per (phase, species key)
+    # a run that gets killed replays the journal on restart and skips everything already finished
+    # each line also holds the species name, as keys are positions in the input and shift when it is edited
+    def __init__(self, path: str, sync_every: int = 50):
+        self.path = path
+        self.sync_every = sync_every
+        self._file = None
+        self._unsynced = 0
+
+    def replay(self, names: dict = None):
+        # returns {phase: {key: (record, found)}}; a torn last line from a crash is ignored
+        # names ({key: species name}) drops entries journaled for another species than the key now stands for
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+        valid_bytes = 0
+        with open(self.path, "rb") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line.decode("utf-8"))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                valid_bytes += len(line)
+                if names is not None and names.get(entry["key"]) != entry.get("name"):
+                    continue
+                completed.setdefault(entry["phase"], {})[entry["key"]] = (entry["record"], entry["found"])
+        # cut off the torn tail so that new entries start on a fresh line
+        with open(self.path, "r+b") as file:
+            file.truncate(valid_bytes)
+        return completed
+
+    def append(self, phase: str, key: str, name: str, record: dict, found: bool):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps({"phase": phase, "key": key, "name": name, "found": found, "record": record}) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def clear(self):
+        # called once the journal has been compacted into the stage output
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
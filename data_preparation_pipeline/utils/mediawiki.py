@@ -0,0 +1,209 @@
+import os
+import sqlite3
+
+from requests.exceptions import RequestException
+
+from utils.http_client import http_client
+
+api_url = "https://{}.wikipedia.org/w/api.php"
+# the MediaWiki API accepts at most 50 titles per query
+TITLES_PER_REQUEST = 50
+WIKI_LANGUAGES = {"eng": "en", "mri": "mi"}
+
+
+def resolve_title(title: str, query: dict):
+    # follow title normalisation (e.g. underscores) and redirects of a requested title
+    renamed = {entry["from"]: entry["to"] for entry in query.get("normalized", [])}
+    renamed.update({entry["from"]: entry["to"] for entry in query.get("redirects", [])})
+    seen = set()
+    while title in renamed and title not in seen:
+        seen.add(title)
+        title = renamed[title]
+    return title
+
+
+# page fields, named as in wikipediaapi, served by each query module
+PROP_FIELDS = {
+    "extracts": ("summary",),
+    "langlinks": ("langlinks",),
+    "info": ("pageid", "title", "ns", "contentmodel", "pagelanguage", "pagelanguagehtmlcode", "pagelanguagedir",
+             "touched", "lastrevid", "length", "canonicalurl", "fullurl", "editurl", "displaytitle"),
+}
+
+
+def query_params(fields):
+    # action=query parameters requesting only the modules the fields need
+    props = [prop for prop, prop_fields in PROP_FIELDS.items() if set(fields) & set(prop_fields)]
+    params = {"action": "query", "prop": "|".join(props), "redirects": 1, "format": "json", "formatversion": 2}
+    if "extracts" in props:
+        # plain text of the lead section, which is what wikipediaapi returns as the summary
+        params.update({"exintro": 1, "explaintext": 1, "exsectionformat": "wiki", "exlimit": "max"})
+    if "langlinks" in props:
+        params["lllimit"] = "max"
+    if "info" in props:
+        params["inprop"] = "url|displaytitle"
+    return params
+
+
+def project_page(page: dict, fields):
+    page_dict = {}
+    for field in fields:
+        if field == "summary":
+            page_dict[field] = page.get("extract", "").strip()
+        elif field == "langlinks":
+            page_dict[field] = [link["lang"] for link in page.get("langlinks", [])]
+        elif field in page:
+            page_dict[field] = page[field]
+    return page_dict
+
+
+def retrieve_pages(language: str, titles: list, fields):
+    # the given fields of up to TITLES_PER_REQUEST pages per action=query call, following continuations
+    # returns ({requested title: page dict}, [titles of batches that failed]), with None for missing pages
+    pages, failed = {}, []
+    titles = list(dict.fromkeys(title for title in titles if title))
+    base_params = query_params(list(fields) + ["title"])
+    for i in range(0, len(titles), TITLES_PER_REQUEST):
+        batch = titles[i:i + TITLES_PER_REQUEST]
+        params = dict(base_params, titles="|".join(batch))
+        found, renamed = {}, {"normalized": [], "redirects": []}
+        try:
+            while True:
+                response = http_client.get(api_url.format(language), params=params)
+                if response.status_code != 200:
+                    raise RequestException(f"status {response.status_code}")
+                data = response.json()
+                query = data.get("query", {})
+                for entry in renamed:
+                    renamed[entry] += query.get(entry, [])
+                # continued responses repeat the pages with the next part of their properties
+                for page in query.get("pages", []):
+                    if page.get("missing") or page.get("invalid"):
+                        continue
+                    merged = found.setdefault(page["title"], {})
+                    for field, value in page.items():
+                        if isinstance(value, list):
+                            merged.setdefault(field, []).extend(value)
+                        else:
+                            merged[field] = value
+                if "continue" not in data:
+                    break
+                params = dict(base_params, titles="|".join(batch), **data["continue"])
+        except (RequestException, ValueError) as e:
+            print(f"error retrieving {len(batch)} {language} pages: {e}")
+            failed += batch
+            continue
+        for title in batch:
+            page = found.get(resolve_title(title, renamed))
+            pages[title] = project_page(page, fields) if page else None
+    return pages, failed
+
+
+def retrieve_page_info(language: str, titles: list):
+    # current revision of many pages: {requested title: (resolved title, lastrevid)}, lastrevid is None for missing pages;
+    # titles whose lookup failed are left out
+    pages, _ = retrieve_pages(language, titles, ("title", "lastrevid"))
+    return {title: (page["title"], page.get("lastrevid")) if page else (title, None) for title, page in pages.items()}
+
+
+class PageSummaryCache:
+    # summaries of pages already harvested or refreshed, keyed by (language, title), with the revision they
+    # were taken from; for English pages also the title of the linked Maori page ('' if there is none)
+    def __init__(self, path: str = "data/cache/wikipedia_pages.sqlite"):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pages (language TEXT, title TEXT, lastrevid INTEGER, "
+                                "summary TEXT, mri_title TEXT, PRIMARY KEY (language, title))")
+
+    def get(self, language: str, title: str):
+        # (lastrevid, summary, mri_title) or None
+        return self.connection.execute("SELECT lastrevid, summary, mri_title FROM pages "
+                                       "WHERE language = ? AND title = ?", (language, title)).fetchone()
+
+    def put(self, language: str, title: str, lastrevid, summary: str, mri_title=None, only_newer: bool = False):
+        # only_newer keeps a stored page unless the given one is a later revision
+        condition = "WHERE pages.lastrevid IS NULL OR excluded.lastrevid > pages.lastrevid" if only_newer else ""
+        self.connection.execute(
+            "INSERT INTO pages VALUES (?, ?, ?, ?, ?) ON CONFLICT(language, title) DO UPDATE SET "
+            "lastrevid = excluded.lastrevid, summary = excluded.summary, mri_title = excluded.mri_title " + condition,
+            (language, title, lastrevid, summary, mri_title))
+
+    def commit(self):
+        self.connection.commit()
+
+
+class DeltaRefresher:
+    # serves Wikipedia summaries from pages already harvested or refreshed, re-downloading only pages
+    # edited since; current revisions are looked up in bulk beforehand with prepare()
+    def __init__(self, eng_wiki, mri_wiki, cache: PageSummaryCache = None):
+        self.wikis = {"en": eng_wiki, "mi": mri_wiki}
+        self.cache = cache or PageSummaryCache()
+        self.current = {}
+        self.reused = 0
+        self.downloaded = 0
+
+    def seed(self, wikidata: dict):
+        # pages harvested by stage 00, which stores their title, summary, lastrevid and langlinks
+        # the Maori title behind an English langlink isn't stored, so it is None (unknown) until needed
+        for record in wikidata.values():
+            for field, language in WIKI_LANGUAGES.items():
+                page = record.get(field)
+                if not page or not page.get("title") or not page.get("lastrevid"):
+                    continue
+                mri_title = ""
+                if language == "en" and "mi" in (page.get("langlinks") or []):
+                    mri_title = None
+                self.cache.put(language, page["title"], page["lastrevid"], page.get("summary", ""), mri_title,
+                               only_newer=True)
+        self.cache.commit()
+
+    def prepare(self, language: str, titles):
+        # bulk revision lookup for the titles that will be asked for
+        missing = [title for title in dict.fromkeys(titles) if title and (language, title) not in self.current]
+        self.current.update({(language, title): info for title, info in retrieve_page_info(language, missing).items()})
+
+    def prepare_summaries(self, page_names):
+        # revisions for summaries(): the English pages first, then the Maori pages they link to, where known
+        self.prepare("en", page_names)
+        mri_titles = []
+        for page_name in page_names:
+            resolved, _ = self.current.get(("en", page_name), (page_name, None))
+            cached = self.cache.get("en", resolved)
+            mri_titles.append(cached[2] if cached and cached[2] else page_name)
+        self.prepare("mi", mri_titles)
+
+    def summary(self, language: str, title: str, need_links: bool = False):
+        # returns (summary, mri_title) of the current revision of a page, ("", "") if the page doesn't exist
+        if (language, title) not in self.current:
+            self.prepare(language, [title])
+        if (language, title) in self.current:
+            resolved, lastrevid = self.current[(language, title)]
+            if lastrevid is None:
+                return "", ""
+        else:
+            # the revision lookup failed, so trust the page as it was harvested
+            resolved, lastrevid = title, None
+        cached = self.cache.get(language, resolved)
+        if cached and (lastrevid is None or cached[0] == lastrevid) and (not need_links or cached[2] is not None):
+            self.reused += 1
+            return cached[1], cached[2]
+        page = self.wikis[language].page(resolved)
+        summary, mri_title = "", ""
+        if page.exists():
+            summary = page.summary
+            if language == "en":
+                langlinks = page.langlinks
+                mri_title = langlinks["mi"].title if "mi" in langlinks else ""
+        self.downloaded += 1
+        self.cache.put(language, resolved, lastrevid, summary, mri_title)
+        self.cache.commit()
+        return summary, mri_title
+
+    def summaries(self, page_name: str):
+        # the English summary of a page and the Maori summary of the page it links to (or of the same title);
+        # errors are raised, so that the caller can keep the summaries it has
+        eng_summary, mri_title = self.summary("en", page_name, need_links=True)
+        mri_summary, _ = self.summary("mi", mri_title or page_name)
+        return eng_summary, mri_summary
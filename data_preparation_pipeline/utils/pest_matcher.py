@@ -0,0 +1,84 @@
+import re
+from collections import deque
+
+# names containing any of these are regular expressions to str.contains, so they can't be matched literally
+REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+class AhoCorasick:
+    # finds every pattern occurring in a text in a single pass over the text
+    def __init__(self, patterns: list):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(pattern_id)
+        # breadth-first construction of the failure links, merging outputs along them
+        # (states directly below the root fail to the root)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def search(self, text: str):
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found.update(self.output[state])
+        return found
+
+
+class PestRegisterIndex:
+    # precompiled index over the (lowercased) register, reproducing per species
+    # (pest_df["Pest name"] == name) | pest_df["Scientific name(s)"].str.contains(name, na=False)
+    def __init__(self, pest_df):
+        self.pest_names = {}
+        for row, pest_name in pest_df["Pest name"].items():
+            if isinstance(pest_name, str):
+                self.pest_names.setdefault(pest_name, []).append(row)
+        self.scientific_names = [(row, text) for row, text in pest_df["Scientific name(s)"].items()
+                                 if isinstance(text, str)]
+
+    def match_all(self, names: dict):
+        # names: species key -> lowercased scientific name; returns sorted (species key, register row) pairs
+        literal, regex = {}, {}
+        for key, name in names.items():
+            target = regex if REGEX_METACHARACTERS & set(name) or not name else literal
+            target.setdefault(name, []).append(key)
+        matches = set()
+        for name, keys in list(literal.items()) + list(regex.items()):
+            for row in self.pest_names.get(name, []):
+                matches.update((key, row) for key in keys)
+        # one pass over the register for all literal names
+        patterns = list(literal.keys())
+        automaton = AhoCorasick(patterns)
+        for row, text in self.scientific_names:
+            for pattern_id in automaton.search(text):
+                matches.update((key, row) for key in literal[patterns[pattern_id]])
+        # the few names str.contains would treat as regular expressions (or the empty name) keep its semantics
+        for name, keys in regex.items():
+            try:
+                compiled = re.compile(name)
+            except re.error:
+                compiled = re.compile(re.escape(name))
+            for row, text in self.scientific_names:
+                if compiled.search(text):
+                    matches.update((key, row) for key in keys)
+        return sorted(matches, key=lambda match: (match[0], str(match[1])))
@@ -0,0 +1,39 @@
+import json
+import os
+
+from utils.species_store import species_store
+
+# set by run_pipeline.py to a JSON list of the species keys a stage has to recompute
+STALE_KEYS_ENV = "PIPELINE_STALE_KEYS"
+# set by run_pipeline.py to a file the stage writes the keys of species whose requests failed to
+FAILED_KEYS_ENV = "PIPELINE_FAILED_KEYS"
+
+
+def load_stale_keys():
+    # species keys to recompute; None means every species (the stage was run by hand or needs a full run)
+    path = os.environ.get(STALE_KEYS_ENV)
+    if not path:
+        return None
+    with open(path, "r") as file:
+        return set(json.load(file))
+
+
+def save_failed_keys(keys):
+    # species whose requests failed; their empty records are recomputed on the next run of the pipeline
+    path = os.environ.get(FAILED_KEYS_ENV)
+    if not path:
+        return
+    with open(path, "w") as file:
+        json.dump(sorted(keys), file)
+
+
+def load_previous_output(table: str, stale_keys):
+    # previous output of a stage, reused for every species that isn't stale
+    if stale_keys is None or not species_store.has_table(table):
+        return {}
+    return species_store.read(table)
+
+
+def is_fresh(key: str, previous: dict, stale_keys):
+    # whether the previous record for a species can be kept as it is
+    return stale_keys is not None and key in previous and key not in stale_keys
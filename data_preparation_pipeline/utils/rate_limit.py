@@ -0,0 +1,31 @@
+import threading
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    # global token-bucket rate limit, shared by all worker threads
+    # rate: tokens added per second, capacity: maximum burst size
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, tokens: float = 1.0):
+        # block until the requested number of tokens is available, return the time spent waiting
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            sleep(wait)
+            waited += wait
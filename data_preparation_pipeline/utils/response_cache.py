@@ -0,0 +1,138 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import Counter
+from functools import wraps
+from time import time
+
+# location of the cache database, relative to the pipeline directory
+cache_path = os.environ.get("RESPONSE_CACHE_PATH", "data/cache/responses.sqlite")
+# serve responses from the cache only and never touch the network
+cache_only = os.environ.get("RESPONSE_CACHE_ONLY", "0") == "1"
+
+# time to live per endpoint, in seconds
+DAY = 24 * 60 * 60
+ENDPOINT_TTLS = {
+    "wikidata_sparql": 30 * DAY,
+    "wikidata_sparql_batch": 30 * DAY,
+    "gbif_vernacular_names": 30 * DAY,
+    "inat_taxa": 7 * DAY,
+    "inat_taxa_batch": 7 * DAY,
+}
+DEFAULT_TTL = 7 * DAY
+# evict least recently used responses once the stored payloads exceed this size
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+# the stored size is tracked per write and re-read from the database every this many writes,
+# which also picks up responses stored by stages running concurrently
+RESYNC_EVERY = 1000
+
+
+class CacheMiss(Exception):
+    # raised in cache-only mode when a response has never been stored
+    pass
+
+
+class ResponseCache:
+    def __init__(self, path: str, ttls: dict = None, max_bytes: int = MAX_CACHE_BYTES):
+        self.path = path
+        self.ttls = ENDPOINT_TTLS if ttls is None else ttls
+        self.max_bytes = max_bytes
+        self.hits = Counter()
+        self.misses = Counter()
+        self._connection = None
+        self._lock = threading.Lock()
+        # bytes of stored payloads, and writes since the total was last read from the database
+        self._total_bytes = None
+        self._puts = 0
+
+    def _connect(self):
+        # open lazily so that importing the module never creates files
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (endpoint TEXT, params TEXT, payload TEXT, size INTEGER, "
+                "stored REAL, accessed REAL, PRIMARY KEY (endpoint, params))")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        return self._connection
+
+    def get(self, endpoint: str, params: str):
+        # returns (found, response); expired responses count as misses
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT payload, stored FROM responses WHERE endpoint = ? AND params = ?",
+                                     (endpoint, params)).fetchone()
+            now = time()
+            if row is not None and now - row[1] <= self.ttls.get(endpoint, DEFAULT_TTL):
+                connection.execute("UPDATE responses SET accessed = ? WHERE endpoint = ? AND params = ?",
+                                   (now, endpoint, params))
+                connection.commit()
+                self.hits[endpoint] += 1
+                return True, json.loads(row[0])
+            self.misses[endpoint] += 1
+            return False, None
+
+    def put(self, endpoint: str, params: str, response):
+        payload = json.dumps(response)
+        now = time()
+        with self._lock:
+            connection = self._connect()
+            if self._total_bytes is None or self._puts >= RESYNC_EVERY:
+                self._total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                self._puts = 0
+            replaced = connection.execute("SELECT size FROM responses WHERE endpoint = ? AND params = ?",
+                                          (endpoint, params)).fetchone()
+            connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                               (endpoint, params, payload, len(payload), now, now))
+            self._total_bytes += len(payload) - (replaced[0] if replaced else 0)
+            self._puts += 1
+            self._evict(connection)
+            connection.commit()
+
+    def _evict(self, connection):
+        if self._total_bytes <= self.max_bytes:
+            return
+        # drop least recently accessed responses until we are at 90% of the limit
+        excess = self._total_bytes - int(self.max_bytes * 0.9)
+        rows = connection.execute("SELECT endpoint, params, size FROM responses ORDER BY accessed")
+        evict = []
+        for endpoint, params, size in rows:
+            if excess <= 0:
+                break
+            evict.append((endpoint, params))
+            excess -= size
+            self._total_bytes -= size
+        connection.executemany("DELETE FROM responses WHERE endpoint = ? AND params = ?", evict)
+
+    def stats(self):
+        endpoints = sorted(set(self.hits) | set(self.misses))
+        return {endpoint: {"hits": self.hits[endpoint], "misses": self.misses[endpoint]} for endpoint in endpoints}
+
+    def print_stats(self):
+        for endpoint, counts in self.stats().items():
+            print(f"response cache '{endpoint}': {counts['hits']} hits, {counts['misses']} misses")
+
+
+response_cache = ResponseCache(cache_path)
+
+
+def cached(endpoint: str):
+    # transparently cache a request function, keyed by endpoint and call arguments
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            params = json.dumps([[str(arg) for arg in args], {k: str(v) for k, v in sorted(kwargs.items())}])
+            found, response = response_cache.get(endpoint, params)
+            if found:
+                return response
+            if cache_only:
+                raise CacheMiss(f"{endpoint} {params}")
+            response = function(*args, **kwargs)
+            response_cache.put(endpoint, params, response)
+            return response
+        return wrapper
+    return decorator
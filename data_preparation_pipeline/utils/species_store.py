@@ -0,0 +1,117 @@
+import json
+import os
+import sqlite3
+
+# location of the store, relative to the pipeline directory
+store_path = os.environ.get("SPECIES_STORE_PATH", "data/species_store.sqlite")
+
+
+class SpeciesStore:
+    # columnar store for the stage outputs: one table per stage, one row per species, one column per field
+    # nested page dicts (e.g. wikidata 'eng'/'mri') are split into 'eng.summary', 'eng.canonicalurl', ... columns,
+    # plus an 'eng' column flagging whether the dict was non-empty, so stages only load the fields they need
+    def __init__(self, path: str = store_path):
+        self.path = path
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # stages run concurrently under run_pipeline.py, so wait for each other's write transactions
+            self._connection = sqlite3.connect(self.path, timeout=600)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        return self._connection
+
+    def has_table(self, table: str):
+        row = self._connect().execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                      (table,)).fetchone()
+        return row is not None
+
+    def columns(self, table: str):
+        return [row[1] for row in self._connect().execute(f'PRAGMA table_info("{table}")')][1:]
+
+    def keys(self, table: str):
+        return [row[0] for row in self._connect().execute(f'SELECT species_key FROM "{table}" ORDER BY rowid')]
+
+    @staticmethod
+    def _flatten(record: dict):
+        columns = {}
+        for field, value in record.items():
+            if isinstance(value, dict) and field in NESTED_FIELDS:
+                columns[field] = bool(value)
+                for subfield, subvalue in value.items():
+                    columns[f"{field}.{subfield}"] = subvalue
+            else:
+                columns[field] = value
+        return columns
+
+    def write(self, table: str, records: dict, replace: bool = True):
+        # writes {species key: record}; replace=False upserts the given species and keeps the others
+        connection = self._connect()
+        rows = {key: self._flatten(record) for key, record in records.items()}
+        fields = list(dict.fromkeys(field for row in rows.values() for field in row))
+        with connection:
+            if replace:
+                connection.execute(f'DROP TABLE IF EXISTS "{table}"')
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (species_key TEXT PRIMARY KEY)')
+            existing = set(self.columns(table))
+            for field in fields:
+                if field not in existing:
+                    connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{field}" TEXT')
+            placeholders = ", ".join("?" for _ in range(len(fields) + 1))
+            names = ", ".join(f'"{field}"' for field in ["species_key"] + fields)
+            # upsert in place, so species keep their position in the table
+            updates = ", ".join(f'"{field}" = excluded."{field}"' for field in fields)
+            connection.executemany(
+                f'INSERT INTO "{table}" ({names}) VALUES ({placeholders}) '
+                f'ON CONFLICT(species_key) DO UPDATE SET {updates}',
+                ([key] + [json.dumps(row[field]) if field in row else None for field in fields]
+                 for key, row in rows.items()))
+
+    def read(self, table: str, columns: list = None):
+        # {species key: record} with only the requested fields, in insertion order
+        # requesting 'eng' loads the whole nested dict, 'eng.summary' only that field of it
+        available = self.columns(table)
+        if columns is None:
+            columns = [column for column in available if "." not in column]
+        selected = []
+        for column in columns:
+            if column in NESTED_FIELDS:
+                selected += [column] + [c for c in available if c.startswith(column + ".")]
+            elif "." in column:
+                selected += [column.split(".")[0], column]
+            else:
+                selected.append(column)
+        selected = [column for column in dict.fromkeys(selected) if column in available]
+        names = ", ".join(f'"{column}"' for column in ["species_key"] + selected)
+        records = {}
+        for row in self._connect().execute(f'SELECT {names} FROM "{table}" ORDER BY rowid'):
+            record = {}
+            for column, raw in zip(selected, row[1:]):
+                # NULL means the species never had this field, as opposed to a stored JSON null
+                if raw is None:
+                    continue
+                value = json.loads(raw)
+                if column in NESTED_FIELDS:
+                    record[column] = {}
+                elif "." in column:
+                    field, subfield = column.split(".", 1)
+                    if field in record:
+                        record[field][subfield] = value
+                else:
+                    record[column] = value
+            records[row[0]] = record
+        return records
+
+    def export_json(self, table: str, path: str):
+        # the app consumes plain JSON, so the final stage is exported in the original format
+        with open(path, "w") as json_file:
+            json.dump(self.read(table), json_file)
+
+
+# fields holding a nested dict per language, split into columns
+NESTED_FIELDS = ("eng", "mri")
+
+species_store = SpeciesStore()
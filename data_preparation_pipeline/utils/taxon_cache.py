@@ -0,0 +1,70 @@
+import json
+import os
+
+from requests.exceptions import RequestException
+from tqdm import tqdm
+
+from utils.response_cache import CacheMiss
+from utils.wikidata_requests import retrieve_inat_taxa, INAT_BATCH_SIZE
+
+# fields kept per taxon node, enough to walk the tree locally
+NODE_FIELDS = ["id", "name", "rank", "ancestor_ids"]
+
+
+class TaxonNodeCache:
+    # in-memory and on-disk cache of iNaturalist taxon nodes, so each node is fetched at most once
+    def __init__(self, path: str = "data/cache/inat_taxon_nodes.json"):
+        self.path = path
+        self.nodes = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                self.nodes = {int(k): v for k, v in json.load(file).items()}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "w") as json_file:
+            json.dump(self.nodes, json_file)
+
+    def add(self, taxon: dict):
+        self.nodes[int(taxon["id"])] = {field: taxon.get(field) for field in NODE_FIELDS}
+
+    def fetch(self, inat_ids):
+        # fetch full taxon records for the given IDs, INAT_BATCH_SIZE per request, keeping their nodes
+        # returns the taxa by ID and the set of IDs whose batch failed
+        inat_ids = list(dict.fromkeys(int(inat_id) for inat_id in inat_ids))
+        taxa = {}
+        failed = set()
+        for i in tqdm(range(0, len(inat_ids), INAT_BATCH_SIZE)):
+            batch = inat_ids[i:i + INAT_BATCH_SIZE]
+            try:
+                response = retrieve_inat_taxa(batch)
+            # a failed request, or a batch never stored in cache-only mode
+            except (RequestException, CacheMiss) as e:
+                print(f"error retrieving {len(batch)} inat taxa: {e}")
+                failed.update(batch)
+                continue
+            for taxon in response["results"]:
+                self.add(taxon)
+                taxa[int(taxon["id"])] = taxon
+        return taxa, failed
+
+    def prefetch(self, inat_ids):
+        # make sure all given nodes are present, requesting only the ones never seen before
+        # returns the set of IDs whose batch failed
+        missing = [inat_id for inat_id in dict.fromkeys(int(i) for i in inat_ids) if inat_id not in self.nodes]
+        failed = set()
+        if missing:
+            _, failed = self.fetch(missing)
+            self.save()
+        return failed
+
+    def find_kingdom(self, ancestors: list):
+        # local tree walk; ancestors[1] is usually the kingdom, directly below "Life"
+        ordered = list(ancestors[1:2]) + list(ancestors)
+        for ancestor in ordered:
+            node = self.nodes.get(int(ancestor))
+            if node and node["rank"] == "kingdom":
+                return node["name"]
+        return None
@@ -1,19 +1,25 @@
 import requests
 from requests.exceptions import RequestException
-from retrying import retry
-from time import sleep
+from utils.response_cache import cached, CacheMiss
+from utils.instrumentation import timed
+from utils.http_client import http_client
 
 # URL for the SPARQL endpoint
 url = "https://query.wikidata.org/sparql"
 gbif_vernacular_url = "https://api.gbif.org/v1/species/"
 inat_response_url = "https://api.inaturalist.org/v1/taxa?taxon_id="
-
-
-@retry(
-    stop_max_attempt_number=10,
-    wait_fixed=2000,
-    retry_on_exception=lambda ex: isinstance(ex, RequestException),
-)
+inat_taxa_url = "https://api.inaturalist.org/v1/taxa/"
+# the iNaturalist taxa endpoint accepts at most 30 comma-separated IDs
+INAT_BATCH_SIZE = 30
+# number of GBIF IDs sent in one SPARQL VALUES clause, and the client-side timeout for a batched query
+SPARQL_BATCH_SIZE = 400
+SPARQL_TIMEOUT = 70
+# attempts per batch for errors other than timeouts, before the batch is split
+BATCH_ATTEMPTS = 3
+
+
+@timed("retrieve_inat_taxon_id_response")
+@cached("wikidata_sparql")
 def retrieve_inat_taxon_id_response(gbif_id: str):
     # SPARQL query you want to send
     sparql_query = "SELECT ?iNat_Taxon_ID ?ITIS_TSN WHERE {?item wdt:P846 \"" + str(
@@ -27,7 +33,7 @@ def retrieve_inat_taxon_id_response(gbif_id: str):
 
     # Sending the GET request
     try:
-        response = requests.get(url, params=params)
+        response = http_client.get(url, params=params)
     except:
         raise RequestException()
 
@@ -45,11 +51,86 @@ def retrieve_inat_taxon_id_response(gbif_id: str):
             raise RequestException(f"HTTP Error {response.status_code}")
 
 
-@retry(
-    stop_max_attempt_number=10,
-    wait_fixed=2000,
-    retry_on_exception=lambda ex: isinstance(ex, RequestException),
-)
+class SparqlTimeout(RequestException):
+    # the query service gave up on a query; retrying the same batch won't help, so it isn't retried
+    pass
+
+
+def is_sparql_timeout(response):
+    # the query service reports its own 60 s limit as a 500 carrying a TimeoutException, or as a 504
+    return response.status_code == 504 or (response.status_code == 500 and "TimeoutException" in response.text)
+
+
+@timed("retrieve_inat_taxon_ids_batch_response")
+@cached("wikidata_sparql_batch")
+def retrieve_inat_taxon_ids_batch_response(gbif_ids: list):
+    # one SPARQL query for many GBIF IDs, each binding carries the GBIF ID it belongs to
+    values = " ".join("\"" + str(gbif_id) + "\"" for gbif_id in gbif_ids)
+    sparql_query = "SELECT ?GBIF_ID ?iNat_Taxon_ID ?ITIS_TSN WHERE {VALUES ?GBIF_ID {" + values + \
+                   "} ?item wdt:P846 ?GBIF_ID.OPTIONAL { ?item wdt:P3151 ?iNat_Taxon_ID. }OPTIONAL { ?item wdt:P815 ?ITIS_TSN. }}"
+
+    # long queries are sent as a form POST
+    data = {
+        "format": "json",  # Response format
+        "query": sparql_query
+    }
+
+    try:
+        response = http_client.post(url, data=data, timeout=SPARQL_TIMEOUT, retry_timeouts=False,
+                                    is_final=is_sparql_timeout)
+    except requests.exceptions.Timeout:
+        raise SparqlTimeout("Query timed out")
+    except:
+        raise RequestException()
+
+    if response.status_code == 200:
+        return response.json()
+    else:
+        if response.status_code == 429:
+            raise RequestException("Too Many Requests")
+        elif is_sparql_timeout(response):
+            raise SparqlTimeout(f"HTTP Error {response.status_code}")
+        else:
+            raise RequestException(f"HTTP Error {response.status_code}")
+
+
+@timed("resolve_inat_taxon_ids")
+def resolve_inat_taxon_ids(gbif_ids: list, batch_size: int = SPARQL_BATCH_SIZE):
+    # map GBIF IDs to (iNat taxon ID, ITIS TSN), batch_size IDs per query; returns the mapping and the IDs that failed
+    # batches that time out are split in half until they go through; batches that fail otherwise are retried
+    # BATCH_ATTEMPTS times and then split; a single ID that still fails is returned as failed
+    # in cache-only mode a batch never stored is split too, as its halves may have been stored by an earlier run
+    resolved = {}
+    failed = set()
+    pending = [(list(gbif_ids[i:i + batch_size]), 1) for i in range(0, len(gbif_ids), batch_size)]
+    while pending:
+        batch, attempt = pending.pop()
+        try:
+            response = retrieve_inat_taxon_ids_batch_response(batch)
+        except (RequestException, CacheMiss) as e:
+            if isinstance(e, RequestException) and not isinstance(e, SparqlTimeout) and attempt < BATCH_ATTEMPTS:
+                pending.append((batch, attempt + 1))
+            elif len(batch) > 1:
+                middle = len(batch) // 2
+                pending.extend([(batch[middle:], 1), (batch[:middle], 1)])
+            else:
+                print(f"couldn't resolve gbif key {batch[0]}: {e}")
+                failed.update(batch)
+            continue
+        for binding in response['results']['bindings']:
+            gbif_id = binding['GBIF_ID']['value']
+            inat_id = binding['iNat_Taxon_ID']['value'] if 'iNat_Taxon_ID' in binding else None
+            itis_tsn = binding['ITIS_TSN']['value'] if 'ITIS_TSN' in binding else None
+            # keep the first binding per GBIF ID, preferring one that carries an iNat taxon ID
+            if gbif_id not in resolved or (resolved[gbif_id][0] is None and inat_id):
+                resolved[gbif_id] = (inat_id, itis_tsn)
+    if failed:
+        print(f"{len(failed)} gbif keys couldn't be resolved and will be retried on the next run")
+    return resolved, failed
+
+
+@timed("retrieve_gbif_vernacular_names")
+@cached("gbif_vernacular_names")
 def retrieve_gbif_vernacular_names(gbif_id: str):
     # SPARQL query you want to send
     query = f"{gbif_vernacular_url}{str(gbif_id)}/vernacularNames"
@@ -61,7 +142,7 @@ def retrieve_gbif_vernacular_names(gbif_id: str):
 
     # Sending the GET request
     try:
-        response = requests.get(query, params=params)
+        response = http_client.get(query, params=params)
     except:
         raise RequestException()
 
@@ -77,11 +158,8 @@ def retrieve_gbif_vernacular_names(gbif_id: str):
             raise RequestException(f"HTTP Error {response.status_code}")
 
 
-@retry(
-    stop_max_attempt_number=10,
-    wait_fixed=2000,
-    retry_on_exception=lambda ex: isinstance(ex, RequestException),
-)
+@timed("retrieve_inat_response")
+@cached("inat_taxa")
 def retrieve_inat_response(inat_id: str):
     # SPARQL query you want to send
     query = f"{inat_response_url}{str(inat_id)}&order=desc&order_by=observations_count"
@@ -92,9 +170,8 @@ def retrieve_inat_response(inat_id: str):
     }
 
     # Sending the GET request
-    connection_error = False
     try:
-        response = requests.get(query, params=params)
+        response = http_client.get(query, params=params)
     except:
         raise RequestException()
 
@@ -108,3 +185,28 @@ def retrieve_inat_response(inat_id: str):
             raise RequestException("Too Many Requests")
         elif response.status_code != 200:
             raise RequestException(f"HTTP Error {response.status_code}")
+
+
+@timed("retrieve_inat_taxa")
+@cached("inat_taxa_batch")
+def retrieve_inat_taxa(inat_ids: list):
+    # fetch up to INAT_BATCH_SIZE taxa by ID in one request; unknown IDs are simply missing from the results
+    query = f"{inat_taxa_url}{','.join(str(inat_id) for inat_id in inat_ids)}"
+
+    params = {
+        "format": "json",  # Response format
+        "per_page": len(inat_ids),
+    }
+
+    try:
+        response = http_client.get(query, params=params)
+    except:
+        raise RequestException()
+
+    if response.status_code == 200:
+        return response.json()
+    else:
+        if response.status_code == 429:
+            raise RequestException("Too Many Requests")
+        elif response.status_code != 200:
+            raise RequestException(f"HTTP Error {response.status_code}")
@@ -0,0 +1,13 @@
+import wikipediaapi
+
+from utils.http_client import http_client
+
+
+class PooledWikipedia(wikipediaapi.Wikipedia):
+    # wikipediaapi page access, with every API round trip (including lazy attributes such as
+    # langlinks, links and categories) sent through the shared pooled, rate-controlled client
+    def _query(self, page, params):
+        base_url = "https://" + page.language + ".wikipedia.org/w/api.php"
+        params["format"] = "json"
+        params["redirects"] = 1
+        return http_client.get(base_url, params=params).json()
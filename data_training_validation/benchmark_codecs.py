@@ -0,0 +1,103 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import torch
+
+import torchvision.datasets as datasets
+import torchvision.transforms as transforms
+
+from PIL import Image
+from tqdm import tqdm
+
+from image_codec import encode, get_codec
+
+# storage codecs compared when none are given on the command line
+CODECS = ['png', 'png:1', 'jpeg:95', 'jpeg:90', 'jpeg:80', 'webp:90', 'webp:80']
+# sample of the sanitised dataset to encode, per codec
+NUM_CLASSES = 100
+IMAGES_PER_CLASS = 20
+# loader settings of fine_tune.py for the 's' model on one GPU
+BATCH_SIZE = 256
+NUM_WORKERS = 16
+CROP_SIZE = 300
+# encoded samples, and the results
+benchmark_dir = 'codec_benchmark'
+results_path = 'codec_benchmark.json'
+
+# a fixed random sample of sanitised images, as (class, file name, path)
+def sample_images(root, num_classes=NUM_CLASSES, images_per_class=IMAGES_PER_CLASS):
+  rng = random.Random(0)
+  classes = sorted(os.listdir(root))
+  samples = []
+  for class_name in sorted(rng.sample(classes, min(num_classes, len(classes)))):
+    filenames = sorted(os.listdir(f'{root}/{class_name}'))
+    for filename in sorted(rng.sample(filenames, min(images_per_class, len(filenames)))):
+      samples.append((class_name, os.path.splitext(filename)[0], f'{root}/{class_name}/{filename}'))
+  return samples
+
+# encode every sample with the codec into its own image folder, timing encoding and decoding
+def encode_samples(codec, images):
+  directory = f"{benchmark_dir}/{codec.name.replace(':', '_')}"
+  shutil.rmtree(directory, ignore_errors=True)
+  encode_seconds = decode_seconds = 0.0
+  total_bytes = 0
+  for class_name, stem, im in tqdm(images, desc=f'encoding {codec.name}'):
+    started = time.perf_counter()
+    content = encode(im, codec)
+    encode_seconds += time.perf_counter() - started
+    started = time.perf_counter()
+    Image.open(io.BytesIO(content)).convert('RGB')
+    decode_seconds += time.perf_counter() - started
+    total_bytes += len(content)
+    os.makedirs(f'{directory}/{class_name}', exist_ok=True)
+    with open(f'{directory}/{class_name}/{stem}{codec.extension}', 'wb') as f:
+      f.write(content)
+  return directory, {
+      'encode_ms': 1000 * encode_seconds / len(images),
+      'decode_ms': 1000 * decode_seconds / len(images),
+      'kb_per_image': total_bytes / 1024 / len(images),
+  }
+
+# images per second through the training data pipeline of fine_tune.py, over one pass of the folder
+def loader_throughput(directory):
+  normalize = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+  dataset = datasets.ImageFolder(
+      directory,
+      transforms.Compose([
+      transforms.RandomResizedCrop(CROP_SIZE),
+      transforms.RandomHorizontalFlip(),
+      transforms.AutoAugment(),
+      transforms.ToTensor(),
+      normalize,
+      ]))
+  loader = torch.utils.data.DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=NUM_WORKERS)
+  # start the workers before timing
+  iterator = iter(loader)
+  started = time.perf_counter()
+  count = 0
+  for images, _ in iterator:
+    count += len(images)
+  return count / (time.perf_counter() - started)
+
+# compare codecs on a sample of the dataset: python benchmark_codecs.py [codec ...], e.g. jpeg:85 webp:75
+if __name__ == '__main__':
+  codecs = [get_codec(spec) for spec in (sys.argv[1:] or CODECS)]
+  root = 'dataset/train' if os.path.exists('dataset/train') else 'dataset'
+  # decode the samples once, so that every codec encodes the same pixels
+  images = []
+  for class_name, stem, path in tqdm(sample_images(root), desc='loading'):
+    with Image.open(path) as im:
+      images.append((class_name, stem, im.convert('RGB')))
+  results = {}
+  for codec in codecs:
+    directory, results[codec.name] = encode_samples(codec, images)
+    results[codec.name]['loader_images_per_second'] = loader_throughput(directory)
+  print(f"{'codec':<10}{'encode ms':>11}{'decode ms':>11}{'KB/image':>10}{'loader img/s':>14}")
+  for name, result in results.items():
+    print(f"{name:<10}{result['encode_ms']:>11.2f}{result['decode_ms']:>11.2f}{result['kb_per_image']:>10.1f}"
+          f"{result['loader_images_per_second']:>14.1f}")
+  json.dump({'source': root, 'images': len(images), 'results': results}, open(results_path, 'w'), indent=2)
@@ -0,0 +1,193 @@
+import csv
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+
+from collections import Counter
+
+from PIL import Image
+from tqdm import tqdm
+from torchvision.datasets.folder import IMG_EXTENSIONS
+
+from download_state import DownloadState, state_path
+from label_mapping import instructions_path, load_mapping
+
+index_path = 'dedup_index.sqlite'
+report_path = 'dedup_report.csv'
+# images of the same class whose perceptual hashes differ in at most this many bits are near-duplicates;
+# the 64-bit hash is split into 4 bands, so by pigeonhole every match up to 3 bits shares at least one band
+NEAR_DUPLICATE_DISTANCE = 3
+NUM_BANDS = 4
+
+
+def dhash(im, size=8):
+  # 64-bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour
+  pixels = list(im.convert('L').resize((size + 1, size), Image.LANCZOS).getdata())
+  value = 0
+  for row in range(size):
+    for column in range(size):
+      value = value << 1 | (pixels[row * (size + 1) + column] > pixels[row * (size + 1) + column + 1])
+  return value
+
+
+def merged_classes(path=instructions_path):
+  # {source class: the source classes merged with it into one dataset class}, so that images the sanitation
+  # instructions merge are compared with each other; without instructions every class stands on its own
+  if not os.path.exists(path):
+    return {}
+  sources = {}
+  for source, target in load_mapping(path):
+    sources.setdefault(target, []).append(source)
+  return {source: merged for merged in sources.values() for source in merged}
+
+
+def image_hashes(content, im):
+  # exact and perceptual hash of an image, computed once for the check before and the indexing after writing it
+  return hashlib.sha256(content).hexdigest(), dhash(im)
+
+
+def bands(value):
+  band_bits = 64 // NUM_BANDS
+  return [(value >> (band_bits * i)) & ((1 << band_bits) - 1) for i in range(NUM_BANDS)]
+
+
+class DedupIndex:
+  # exact (sha256 of the bytes) and perceptual (dHash) hash of every stored image, per source class;
+  # an image is compared with the images of every source class merged into the same dataset class
+  def __init__(self, path=index_path, groups=None):
+    self.groups = merged_classes() if groups is None else groups
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    band_columns = ', '.join(f'band{i} INTEGER' for i in range(NUM_BANDS))
+    self.connection.execute(
+        f'CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, class TEXT, sha256 TEXT, dhash TEXT, {band_columns})')
+    self.connection.execute('CREATE INDEX IF NOT EXISTS images_sha256 ON images (class, sha256)')
+    for i in range(NUM_BANDS):
+      self.connection.execute(f'CREATE INDEX IF NOT EXISTS images_band{i} ON images (class, band{i})')
+    self.connection.execute(
+        'CREATE TABLE IF NOT EXISTS duplicates (path TEXT PRIMARY KEY, class TEXT, duplicate_of TEXT, kind TEXT, '
+        'distance INTEGER)')
+    self._lock = threading.Lock()
+
+  def find(self, class_name, digest, perceptual, path=None):
+    # (stored path, kind, distance) of another image of the class duplicated by this one, or None;
+    # entries whose file is gone, e.g. deleted by hand, no longer count
+    classes = self.groups.get(class_name, [class_name])
+    class_condition = f'class IN ({", ".join("?" * len(classes))})'
+    rows = self.connection.execute(f'SELECT path FROM images WHERE {class_condition} AND sha256 = ? AND path IS NOT ?',
+                                   classes + [digest, path])
+    for row in rows:
+      if os.path.exists(row[0]):
+        return row[0], 'exact', 0
+    condition = ' OR '.join(f'band{i} = ?' for i in range(NUM_BANDS))
+    candidates = self.connection.execute(
+        f'SELECT path, dhash FROM images WHERE {class_condition} AND path IS NOT ? AND ({condition})',
+        classes + [path] + bands(perceptual))
+    best = None
+    for other_path, other in candidates:
+      distance = bin(perceptual ^ int(other, 16)).count('1')
+      if distance <= NEAR_DUPLICATE_DISTANCE and (best is None or distance < best[2]) and os.path.exists(other_path):
+        best = (other_path, 'near', distance)
+    return best
+
+  def _record_duplicate(self, path, class_name, match):
+    self.connection.execute('INSERT OR REPLACE INTO duplicates VALUES (?, ?, ?, ?, ?)',
+                            (path, class_name, match[0], match[1], match[2]))
+
+  def check(self, path, class_name, hashes):
+    # the duplicate match of an image not stored yet, or None; the image is not indexed, so that
+    # an image whose write fails is not taken for a duplicate of itself when it is downloaded again
+    with self._lock:
+      match = self.find(class_name, *hashes, path)
+      if match:
+        self._record_duplicate(path, class_name, match)
+        self.connection.commit()
+    return match
+
+  def add(self, path, class_name, hashes):
+    # indexes a stored image unless it duplicates one already indexed; returns the duplicate match or None
+    digest, perceptual = hashes
+    with self._lock:
+      match = self.find(class_name, digest, perceptual, path)
+      if match:
+        self._record_duplicate(path, class_name, match)
+      else:
+        self.connection.execute('DELETE FROM duplicates WHERE path = ?', (path,))
+        self.connection.execute(f'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, {", ".join("?" * NUM_BANDS)})',
+                                [path, class_name, digest, f'{perceptual:016x}'] + bands(perceptual))
+      self.connection.commit()
+    return match
+
+  def recheck(self, path):
+    # checks an indexed image again, e.g. against classes merged with its own since it was indexed;
+    # a duplicate is taken out of the index, and the match returned as by add
+    with self._lock:
+      row = self.connection.execute('SELECT class, sha256, dhash FROM images WHERE path = ?', (path,)).fetchone()
+      if row is None:
+        return None
+      class_name, digest, perceptual = row[0], row[1], int(row[2], 16)
+      match = self.find(class_name, digest, perceptual, path)
+      if match:
+        self.connection.execute('DELETE FROM images WHERE path = ?', (path,))
+        self._record_duplicate(path, class_name, match)
+        self.connection.commit()
+    return match
+
+  def report(self, path=report_path):
+    # every removed duplicate to a CSV file, and the number per class and kind to the console
+    rows = self.connection.execute(
+        'SELECT class, path, duplicate_of, kind, distance FROM duplicates ORDER BY class, path').fetchall()
+    with open(path, 'w', newline='') as file:
+      writer = csv.writer(file)
+      writer.writerow(['class', 'path', 'duplicate_of', 'kind', 'distance'])
+      writer.writerows(rows)
+    counts = Counter((row[0], row[3]) for row in rows)
+    for class_name in sorted({row[0] for row in rows}):
+      print(f"{class_name}: {counts[(class_name, 'exact')]} exact, {counts[(class_name, 'near')]} near duplicates")
+    print(f'{len(rows)} duplicates in total, listed in {path}')
+
+
+def scan(roots, remove=False):
+  # indexes images downloaded before deduplication, the first root winning ties; duplicates are deleted if remove,
+  # and recorded as such in the download state so that they are neither downloaded again nor counted as stored
+  index = DedupIndex()
+  state = DownloadState() if remove and os.path.exists(state_path) else None
+  stored = {row[0] for row in index.connection.execute('SELECT path FROM images')}
+  indexed = stored | {row[0] for row in index.connection.execute('SELECT path FROM duplicates')}
+  images = [(f'{root}/{class_name}/{filename}', class_name) for root in roots if os.path.isdir(root)
+            for class_name in sorted(os.listdir(root)) if os.path.isdir(f'{root}/{class_name}')
+            for filename in sorted(os.listdir(f'{root}/{class_name}')) if filename.lower().endswith(IMG_EXTENSIONS)]
+  # images indexed earlier are checked again from their stored hashes, e.g. against classes merged with theirs since;
+  # the last copy goes first, so that the first one is kept
+  duplicates = [path for path, _ in tqdm(images[::-1], desc='rechecking') if path in stored and index.recheck(path)]
+  for path, class_name in tqdm(images, desc='indexing'):
+    if path in indexed:
+      continue
+    try:
+      with open(path, 'rb') as file:
+        content = file.read()
+      with Image.open(path) as im:
+        match = index.add(path, class_name, image_hashes(content, im))
+    except Exception:
+      print('unreadable', path, flush=True)
+      continue
+    if match:
+      duplicates.append(path)
+  if remove:
+    for path in duplicates:
+      os.remove(path)
+      if state is not None:
+        state.mark_duplicate(path)
+  if state is not None:
+    state.commit()
+  index.report()
+
+
+# index existing downloads: python dedup.py scan [--remove]
+# report removed duplicates: python dedup.py
+if __name__ == '__main__':
+  if sys.argv[1:2] == ['scan']:
+    scan(['res_grade', 'cap_cul'], remove='--remove' in sys.argv[2:])
+  else:
+    DedupIndex().report()
@@ -1,53 +1,35 @@
-import os
 import sys
-import magic
-import socket
-import urllib.request
 
 import pandas as pd
 
-from PIL import Image
-from tqdm import tqdm
 from torchvision.datasets.folder import IMG_EXTENSIONS
 
-# decrease wait time for each download
-socket.setdefaulttimeout(15)
+from downloader import download_manifest, manifest_is_current, save_manifest
+from gbif_export import load_gbif_index
 
-# IDs and URLs
-multimedia = pd.read_csv('multimedia.txt', delimiter = '\t')
-# IDs and labels
-dataset = pd.read_csv('NZ-Species.csv', delimiter = '\t')
-# iterate through instances to download
-for i, row in tqdm(multimedia.iterrows()):
-    species_dir = 'res_grade/' +  dataset.loc[dataset['gbifID'] == row['gbifID'], 'verbatimScientificName'].iat[0]
-    filename = species_dir + '/' + str(i) + '_' + str(row['gbifID']) + '.' + str(row['format']).split('/')[-1]
+manifest_path = 'res_grade_manifest.csv'
+
+# plan the downloads once; the plan is reused until the source files change
+if not manifest_is_current(manifest_path, ['multimedia.txt', 'NZ-Species.csv']):
+    # IDs and URLs
+    multimedia = pd.read_csv('multimedia.txt', delimiter = '\t')
+    # labels indexed by ID, the first label per ID, from the Parquet cache of the export
+    labels = load_gbif_index('gbifID', ['verbatimScientificName'])
+    # label every instance with one join, keeping the order of multimedia.txt
+    plan = multimedia.rename_axis('index').reset_index().join(labels, on = 'gbifID')
+    unlabelled = plan['verbatimScientificName'].isna()
+    if unlabelled.any():
+        print(f'\nSkipped {unlabelled.sum()} instances without a label in NZ-Species.csv', flush=True)
+    plan = plan[~unlabelled].copy()
+    plan['record_id'] = plan['gbifID'].astype(str)
+    plan['url'] = plan['identifier'].astype(str)
+    plan['filename'] = 'res_grade/' + plan['verbatimScientificName'] + '/' + plan['index'].astype(str) + '_' + \
+        plan['record_id'] + '.' + plan['format'].astype(str).str.split('/').str[-1]
     # skip files in incompatible formats
-    if not (str(row['identifier']).lower().endswith(('.',) + IMG_EXTENSIONS) or filename.lower().endswith(('.',) + IMG_EXTENSIONS)):
-        print('\nSkipped', str(i), row['gbifID'], row['identifier'], flush=True)
-        continue
-    try:
-        if not os.path.exists(species_dir):
-            os.makedirs(species_dir)
-        if os.path.exists(filename):
-            continue
-        urllib.request.urlretrieve(row['identifier'], filename)
-        try:
-            # download file and save in RGB mode
-            im = Image.open(filename).convert('RGB')
-            if filename.lower().endswith(IMG_EXTENSIONS):
-                im.save(filename)
-            else:
-                # determine format for files missing this information
-                os.remove(filename)
-                pil_extension = '.' + im.format.lower()
-                if pil_extension in IMG_EXTENSIONS:
-                    im.save(filename.split('.')[0] + pil_extension)
-                else:
-                    print('\nRemoved incompatible', str(i), row['gbifID'], row['identifier'], flush=True)
-        # remove corrupted files
-        except:
-            print('\nRemoved unreadable', str(i), row['gbifID'], row['identifier'], flush=True)
-            os.remove(filename)
-    # report failed downloads
-    except:
-        print('\nFailed to acquire', str(i), row['gbifID'], row['identifier'], flush=True)
+    compatible = plan['url'].str.lower().map(lambda url: url.endswith(('.',) + IMG_EXTENSIONS)) | \
+        plan['filename'].str.lower().map(lambda filename: filename.endswith(('.',) + IMG_EXTENSIONS))
+    for row in plan[~compatible].itertuples():
+        print('\nSkipped', str(row.index), row.record_id, row.url, flush=True)
+    save_manifest(plan[compatible], manifest_path)
+# download concurrently; with --ingest, store training-ready 512 px PNGs instead of the originals
+download_manifest(manifest_path, ingest = '--ingest' in sys.argv[1:])
@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import sys
+import time
+
+from collections import namedtuple
+
+state_path = 'download_state.sqlite'
+# number of runs that attempt an image before its failure counts as permanent, per error class
+RETRY_LIMITS = {
+  # 403/404/410: the image is gone
+    'not_found': 1,
+  # any other 4xx response
+    'http_error': 2,
+  # timeouts, connection errors, and 429/5xx responses that outlasted the in-run retries
+    'network': 5,
+  # downloaded, but not an image PIL can open
+    'unreadable': 2,
+  # an image, but not in a format torchvision can load
+    'incompatible': 1,
+  # the image could not be written, e.g. to a full disk
+    'storage': 3,
+}
+DEFAULT_RETRY_LIMIT = 3
+# updates written per transaction
+COMMIT_EVERY = 500
+
+# outcome of one attempt: 'done' or 'failed', the error class if failed, and the stored file
+DownloadOutcome = namedtuple('DownloadOutcome', ['status', 'error', 'path', 'bytes', 'sha256'])
+
+
+class DownloadState:
+  # status, bytes, content hash, error class and attempt count of every image in the download manifests
+  def __init__(self, path=state_path):
+    self.connection = sqlite3.connect(path)
+    self.connection.execute(
+        'CREATE TABLE IF NOT EXISTS images (filename TEXT PRIMARY KEY, manifest TEXT, idx INTEGER, record_id TEXT, '
+        'url TEXT, license TEXT, status TEXT, error TEXT, attempts INTEGER, path TEXT, bytes INTEGER, '
+        'sha256 TEXT, updated REAL)')
+    self.connection.execute('CREATE INDEX IF NOT EXISTS images_status ON images (status)')
+    self._uncommitted = 0
+
+  def sync(self, manifest_name, manifest):
+    # adds the manifest rows not seen before; images already on disk from earlier runs count as done
+    known = {row[0] for row in self.connection.execute('SELECT filename FROM images WHERE manifest = ?',
+                                                       (manifest_name,))}
+    new_rows = manifest[~manifest['filename'].isin(known)]
+    # one directory listing per class rather than one existence check per image
+    listings = {}
+    rows = []
+    for row in new_rows.itertuples(index=False):
+      directory, name = os.path.split(row.filename)
+      if directory not in listings:
+        listings[directory] = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+      status = 'done' if name in listings[directory] else 'pending'
+      rows.append((row.filename, manifest_name, row.index, row.record_id, row.url, row.license, status, None, 0,
+                   row.filename if status == 'done' else None, None, None, time.time()))
+    with self.connection:
+      self.connection.executemany('INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+  def pending(self, manifest_name):
+    # images never attempted, and failed ones whose error class allows another attempt
+    limits = ' '.join(f"WHEN '{error}' THEN {limit}" for error, limit in RETRY_LIMITS.items())
+    return self.connection.execute(
+        'SELECT idx, record_id, url, filename FROM images WHERE manifest = ? AND (status = \'pending\' OR '
+        f'(status = \'failed\' AND attempts < CASE error {limits} ELSE {DEFAULT_RETRY_LIMIT} END)) '
+        'ORDER BY idx', (manifest_name,)).fetchall()
+
+  def record(self, filename, outcome):
+    self.connection.execute(
+        'UPDATE images SET status = ?, error = ?, attempts = attempts + 1, path = ?, bytes = ?, sha256 = ?, '
+        'updated = ? WHERE filename = ?',
+        (outcome.status, outcome.error, outcome.path, outcome.bytes, outcome.sha256, time.time(), filename))
+    self._uncommitted += 1
+    if self._uncommitted >= COMMIT_EVERY:
+      self.commit()
+
+  def mark_duplicate(self, path):
+    # an image removed from disk as a duplicate of another one; it is not downloaded again
+    self.connection.execute(
+        "UPDATE images SET status = 'duplicate', error = NULL, path = NULL, updated = ? WHERE path = ? OR filename = ?",
+        (time.time(), path, path))
+    self._uncommitted += 1
+    if self._uncommitted >= COMMIT_EVERY:
+      self.commit()
+
+  def commit(self):
+    self.connection.commit()
+    self._uncommitted = 0
+
+  def summary(self):
+    # (manifest, status, error class, images, bytes, images that will be retried)
+    limits = ' '.join(f"WHEN '{error}' THEN {limit}" for error, limit in RETRY_LIMITS.items())
+    return self.connection.execute(
+        'SELECT manifest, status, COALESCE(error, \'\'), COUNT(*), COALESCE(SUM(bytes), 0), '
+        f'SUM(status = \'failed\' AND attempts < CASE error {limits} ELSE {DEFAULT_RETRY_LIMIT} END) '
+        'FROM images GROUP BY manifest, status, error ORDER BY manifest, status, error').fetchall()
+
+  def print_summary(self):
+    print(f"{'manifest':<24}{'status':<10}{'error':<14}{'images':>10}{'MB':>12}{'retryable':>11}")
+    for manifest, status, error, images, size, retryable in self.summary():
+      print(f'{manifest:<24}{status:<10}{error:<14}{images:>10}{size / 2 ** 20:>12.1f}{retryable:>11}')
+
+
+# print the state of the downloaded corpus
+if __name__ == '__main__':
+  DownloadState(sys.argv[1] if len(sys.argv) > 1 else state_path).print_summary()
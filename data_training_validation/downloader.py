@@ -0,0 +1,272 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import namedtuple
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import requests
+
+import pandas as pd
+
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from torchvision import transforms
+from torchvision.datasets.folder import IMG_EXTENSIONS
+
+from dedup import DedupIndex, image_hashes
+from download_state import DownloadOutcome, DownloadState
+
+# number of images downloaded at once
+NUM_WORKERS = 64
+# connections open at once to one host, e.g. the iNaturalist image bucket
+PER_HOST_LIMIT = 16
+# wait time for each download
+TIMEOUT = 15
+# attempts per image, and the first backoff between them (doubled on every further attempt)
+MAX_ATTEMPTS = 4
+BACKOFF = 1.0
+
+# PIL formats stored by the ingest mode: those of the extensions torchvision loads, plus MPO,
+# the multi-picture JPEG of many phones and cameras, which PIL reports as a format of its own
+INGEST_FORMATS = {'JPEG', 'MPO', 'PNG', 'WEBP', 'BMP', 'TIFF', 'PPM'}
+
+# resize data for training, as in perform_sanitise_instructions.py
+t_512 = transforms.Resize(512)
+
+# one image to download: its row index and record ID (for logging), source URL and target file
+DownloadTask = namedtuple('DownloadTask', ['index', 'record_id', 'url', 'filename'])
+# download plan saved by download_res_grade.py and download_cap_cul.py, one row per image
+MANIFEST_COLUMNS = ['index', 'record_id', 'url', 'filename', 'license']
+
+
+class Downloader:
+  # thread-pooled downloads over keep-alive connections, with per-host limits and retries
+  def __init__(self, num_workers=NUM_WORKERS, per_host_limit=PER_HOST_LIMIT):
+    self.num_workers = num_workers
+    self.per_host_limit = per_host_limit
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=per_host_limit, max_retries=0)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self._host_slots = {}
+    self._lock = threading.Lock()
+
+  def _slots(self, host):
+    with self._lock:
+      if host not in self._host_slots:
+        self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+      return self._host_slots[host]
+
+  def fetch(self, url):
+    # returns the response body, retrying connection errors, 429 and 5xx responses with backoff
+    slots = self._slots(urlsplit(url).netloc)
+    for attempt in range(MAX_ATTEMPTS):
+      backoff = BACKOFF * 2 ** attempt
+      try:
+        with slots:
+          response = self.session.get(url, timeout=TIMEOUT)
+        if response.status_code == 429 or response.status_code >= 500:
+          if attempt == MAX_ATTEMPTS - 1:
+            response.raise_for_status()
+          retry_after = response.headers.get('Retry-After', '')
+          time.sleep(float(retry_after) if retry_after.isdigit() else backoff)
+          continue
+        response.raise_for_status()
+        return response.content
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        if attempt == MAX_ATTEMPTS - 1:
+          raise
+        time.sleep(backoff)
+
+  def _download(self, task, process):
+    try:
+      content = self.fetch(task.url)
+    except Exception as e:
+      return DownloadOutcome('failed', classify_error(e), None, None, None)
+    try:
+      error, path = process(task, content)
+    # anything process did not classify itself, so that one image cannot abort the run
+    except OSError:
+      error, path = 'storage', None
+    except Exception:
+      error, path = 'unreadable', None
+    if error == 'duplicate':
+      status, error = 'duplicate', None
+    else:
+      status = 'failed' if error else 'done'
+    return DownloadOutcome(status, error, path, len(content), hashlib.sha256(content).hexdigest())
+
+  def run(self, tasks, process, record):
+    # downloads every task and hands its bytes to process(task, content) in the worker thread,
+    # which returns (error class, 'duplicate' or None; stored file); record(task, outcome) runs in this thread
+    failed = 0
+    downloaded_bytes = 0
+    started = time.monotonic()
+    tasks = list(tasks)
+    progress = tqdm(total=len(tasks), unit='img', smoothing=0.05)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+      for task in tasks + [None]:
+        # keep a bounded number of downloads queued, rather than one future per image up front
+        if task is not None:
+          pending[executor.submit(self._download, task, process)] = task
+          if len(pending) < self.num_workers * 4:
+            continue
+        while pending:
+          finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+          for future in finished:
+            outcome = future.result()
+            record(pending.pop(future), outcome)
+            failed += outcome.status == 'failed'
+            downloaded_bytes += outcome.bytes or 0
+          megabytes_per_second = downloaded_bytes / 2 ** 20 / max(time.monotonic() - started, 1e-6)
+          progress.set_postfix(MBps=f'{megabytes_per_second:.1f}', failed=failed, refresh=False)
+          progress.update(len(finished))
+          if task is not None:
+            break
+    progress.close()
+    return failed
+
+
+def classify_error(error):
+  # error class of a failed download, which decides whether later runs retry it
+  if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+    status = error.response.status_code
+    if status in (403, 404, 410):
+      return 'not_found'
+    if status < 500 and status != 429:
+      return 'http_error'
+  return 'network'
+
+
+def is_duplicate(index, path, hashes):
+  # checks the image against the images of its class already stored, before it is written
+  return index is not None and index.check(path, os.path.basename(os.path.dirname(path)), hashes) is not None
+
+
+def index_stored(index, path, hashes):
+  # indexes the image once it is written; True if another download stored a duplicate of it in the meantime
+  return index is not None and index.add(path, os.path.basename(os.path.dirname(path)), hashes) is not None
+
+
+def save_image(task, content, index=None):
+  # save the downloaded file in RGB mode, with its extension determined from the image if missing
+  # returns (error class, 'duplicate' or None; stored file)
+  filename = task.filename
+  try:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as file:
+      file.write(content)
+  # e.g. a full disk or missing permissions, which should not stop the other downloads
+  except OSError:
+    return 'storage', None
+  try:
+    opened = Image.open(filename)
+    im = opened.convert('RGB')
+    path = filename
+    if not filename.lower().endswith(IMG_EXTENSIONS):
+      # determine format for files missing this information
+      os.remove(filename)
+      pil_extension = '.' + opened.format.lower()
+      if pil_extension not in IMG_EXTENSIONS:
+        return 'incompatible', None
+      path = os.path.splitext(filename)[0] + pil_extension
+  # remove corrupted files
+  except Exception:
+    if os.path.exists(filename):
+      os.remove(filename)
+    return 'unreadable', None
+  hashes = image_hashes(content, im) if index is not None else None
+  if is_duplicate(index, path, hashes):
+    if os.path.exists(filename):
+      os.remove(filename)
+    return 'duplicate', None
+  try:
+    im.save(path)
+  except OSError:
+    if os.path.exists(path):
+      os.remove(path)
+    return 'storage', None
+  if index_stored(index, path, hashes):
+    os.remove(path)
+    return 'duplicate', None
+  return None, path
+
+
+def manifest_is_current(manifest_path, source_paths):
+  # a manifest is rebuilt whenever one of the files it was built from changed since
+  return os.path.exists(manifest_path) and all(os.path.getmtime(manifest_path) >= os.path.getmtime(path)
+                                                for path in source_paths)
+
+
+def save_manifest(plan, manifest_path):
+  # plan: data frame with one row per image to download
+  plan.loc[:, MANIFEST_COLUMNS].to_csv(manifest_path, index=False)
+
+
+def load_manifest(manifest_path):
+  return pd.read_csv(manifest_path, dtype={'record_id': str, 'url': str, 'filename': str, 'license': str},
+                     keep_default_na=False)
+
+
+def ingest_image(task, content, index=None):
+  # decode the downloaded bytes once in memory, resize to 512 and write the training-ready PNG,
+  # which perform_sanitise_instructions.py links into the dataset without decoding it again
+  # returns (error class, 'duplicate' or None; stored file)
+  try:
+    opened = Image.open(io.BytesIO(content))
+    # the format is sniffed from the content, whatever the URL or manifest claims
+    if opened.format not in INGEST_FORMATS:
+      return 'incompatible', None
+    im = t_512(opened.convert('RGB'))
+  except Exception:
+    return 'unreadable', None
+  path = os.path.splitext(task.filename)[0] + '.png'
+  hashes = image_hashes(content, opened) if index is not None else None
+  if is_duplicate(index, path, hashes):
+    return 'duplicate', None
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write under a temporary name so that an interrupted run never leaves a truncated image behind
+    im.save(path + '.part', format='PNG', optimize=True)
+    os.replace(path + '.part', path)
+  # e.g. a full disk or missing permissions, which should not stop the other downloads
+  except OSError:
+    if os.path.exists(path + '.part'):
+      os.remove(path + '.part')
+    return 'storage', None
+  if index_stored(index, path, hashes):
+    os.remove(path)
+    return 'duplicate', None
+  return None, path
+
+
+def download_manifest(manifest_path, ingest=False, dedup=True, num_workers=NUM_WORKERS,
+                      per_host_limit=PER_HOST_LIMIT):
+  # download every image of the manifest that is pending or may be retried, recording the outcomes
+  # ingest stores 512 px PNGs straight away instead of the original images
+  # dedup skips exact and near duplicates of images already stored in the same class
+  state = DownloadState()
+  added = state.sync(manifest_path, load_manifest(manifest_path))
+  tasks = [DownloadTask(*row) for row in state.pending(manifest_path)]
+  print(f'{added} new images in {manifest_path}, {len(tasks)} to download', flush=True)
+
+  def record(task, outcome):
+    state.record(task.filename, outcome)
+
+  index = DedupIndex() if dedup else None
+  process = partial(ingest_image if ingest else save_image, index=index)
+  try:
+    failed = Downloader(num_workers, per_host_limit).run(tasks, process, record)
+  # keep the outcomes recorded so far, even if the run is interrupted
+  finally:
+    state.commit()
+  state.print_summary()
+  if index is not None:
+    index.report()
+  return failed
@@ -10,7 +10,6 @@ import torch.nn as nn
 import torch.cuda.amp as amp
 import torch.distributed as dist
 import torch.multiprocessing as mp
-import torchvision.datasets as datasets
 import torchvision.transforms as transforms
 
 from torch.optim import RMSprop
@@ -18,6 +17,8 @@ from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.tensorboard import SummaryWriter
 from pathlib import Path
 
+from split_manifest import ManifestDataset
+
 # number of GPUs
 WORLD_SIZE = 4
 # batch size per GPU for each model size
@@ -30,8 +31,10 @@ BATCH_SIZE = BATCH_SIZES[MODEL_SIZE]
 # each number in the middle unfreezes one block
 # from the classifier's side to the input side
 EPOCHS = [5, 495]
-# specify the split for training
+# specify the split for training: 'train', or 'full' for every image of the manifest
 SPLIT = sys.argv[2]
+# manifest written by split.py, e.g. split_manifest_fold1of5.csv for cross-validation
+SPLIT_MANIFEST = 'split_manifest.csv'
 # specify a checkpoint to load if resuming fine-tuning
 LOAD_CHECKPOINT = None if sys.argv[3] == 'None' else int(sys.argv[3])
 # specify a port to use for distributed data parallelism
@@ -61,15 +64,14 @@ def train(rank):
     # set up data pipeline
     normalize = transforms.Normalize(mean=[0.5, 0.5, 0.5],
                                      std=[0.5, 0.5, 0.5])
-    train_dataset = datasets.ImageFolder(
-        f'dataset/{SPLIT}',
-        transforms.Compose([
-            transforms.RandomResizedCrop(300 if MODEL_SIZE == 's' else 384),
-            transforms.RandomHorizontalFlip(),
-            transforms.AutoAugment(),
-            transforms.ToTensor(),
-            normalize,
-        ]))
+    train_transform = transforms.Compose([
+        transforms.RandomResizedCrop(300 if MODEL_SIZE == 's' else 384),
+        transforms.RandomHorizontalFlip(),
+        transforms.AutoAugment(),
+        transforms.ToTensor(),
+        normalize,
+    ])
+    train_dataset = ManifestDataset(SPLIT_MANIFEST, SPLIT, train_transform)
     train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset, num_replicas=WORLD_SIZE, rank=rank)
     train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=16, sampler=train_sampler, pin_memory=True)
     print('GPU', rank, 'loader ready', flush=True)
@@ -0,0 +1,87 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# the single implementation of the Parquet cache of the export, also used by the data preparation pipeline,
+# whose utils/gbif_export.py loads this file by path; it only uses pandas, numpy and pyarrow APIs that the
+# versions pinned on both sides share
+
+# the tab-separated GBIF occurrence export
+export_path = 'NZ-Species.csv'
+# columns of the export used by the training scripts and the pipeline, and their types;
+# everything else is left out of the cache
+COLUMNS = {
+    'gbifID': 'int64',
+    'taxonKey': 'Int64',
+    'verbatimScientificName': 'str',
+    'taxonRank': 'str',
+    'kingdom': 'str',
+    'phylum': 'str',
+    'class': 'str',
+    'order': 'str',
+    'family': 'str',
+    'genus': 'str',
+    'species': 'str',
+}
+ROW_GROUP_SIZE = 1_000_000
+# stored in the Parquet metadata, a cache written with another version is rebuilt; bump it when COLUMNS change
+SCHEMA_VERSION = '1'
+SCHEMA_KEY = b'gbif_export_schema'
+
+
+def cache_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+
+def convert(csv_path=export_path):
+    # one-time conversion of the export into a typed, column-pruned Parquet file next to it
+    header = pd.read_csv(csv_path, delimiter='\t', nrows=0).columns
+    columns = [column for column in COLUMNS if column in header]
+    frame = pd.read_csv(csv_path, delimiter='\t', usecols=columns, dtype={column: COLUMNS[column] for column in columns})
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), SCHEMA_KEY: SCHEMA_VERSION.encode()})
+    pq.write_table(table, cache_path(csv_path) + '.part', row_group_size=ROW_GROUP_SIZE)
+    os.replace(cache_path(csv_path) + '.part', cache_path(csv_path))
+    return frame
+
+
+def cache_is_current(csv_path=export_path):
+    # the cache exists, is not older than the export and was written with this schema
+    path = cache_path(csv_path)
+    if not os.path.exists(path):
+        return False
+    if os.path.exists(csv_path) and os.path.getmtime(path) < os.path.getmtime(csv_path):
+        return False
+    metadata = pq.read_schema(path).metadata or {}
+    return metadata.get(SCHEMA_KEY) == SCHEMA_VERSION.encode()
+
+
+def load_gbif_export(columns=None, csv_path=export_path):
+    # the export with only the given columns, read from its Parquet cache, which is rebuilt when the export changes
+    path = cache_path(csv_path)
+    if not cache_is_current(csv_path):
+        print(f'converting {csv_path} into {path}...', flush=True)
+        convert(csv_path)
+    frame = pd.read_parquet(path, columns=columns, memory_map=True)
+    # missing strings as NaN, as read_csv returns them
+    for column in frame.columns:
+        if frame[column].dtype == object:
+            frame[column] = frame[column].where(frame[column].notna(), np.nan)
+    return frame
+
+
+def load_gbif_index(key, columns, csv_path=export_path):
+    # the given columns indexed by gbifID, taxonKey or verbatimScientificName, for lookups without scanning;
+    # the first row per key wins, as with a scan of the export
+    frame = load_gbif_export([key] + columns, csv_path)
+    return frame.drop_duplicates(key).set_index(key)
+
+
+# convert the export ahead of time: python gbif_export.py [export]
+if __name__ == '__main__':
+    converted = convert(sys.argv[1] if len(sys.argv) > 1 else export_path)
+    print(f'{len(converted)} rows, columns {list(converted.columns)}')
@@ -0,0 +1,38 @@
+import io
+
+from collections import namedtuple
+
+# how sanitised training images are stored: PIL format, file extension and save options
+StorageCodec = namedtuple('StorageCodec', ['name', 'format', 'extension', 'options'])
+
+# the format of the stored dataset, as name[:quality]:
+# png is lossless and takes an optional zlib level (0-9) instead of the slow optimize pass,
+# jpeg and webp take a quality (1-100)
+DEFAULT_CODEC = 'png'
+DEFAULT_QUALITY = {'jpeg': 90, 'webp': 90}
+# file extensions of every codec, to find images of the dataset stored with another codec
+CODEC_EXTENSIONS = ('.png', '.jpg', '.webp')
+
+
+def get_codec(spec=DEFAULT_CODEC):
+  # e.g. 'png', 'png:1', 'jpeg:90', 'webp:80'
+  name, _, quality = spec.lower().partition(':')
+  if name == 'png':
+    # without a level, the smallest file, as the dataset has always been stored
+    options = {'compress_level': int(quality)} if quality else {'optimize': True}
+    return StorageCodec(spec, 'PNG', '.png', options)
+  if name in ('jpeg', 'jpg'):
+    # no chroma subsampling, which would blur the fine colour patterns of small species
+    options = {'quality': int(quality or DEFAULT_QUALITY['jpeg']), 'subsampling': 0}
+    return StorageCodec(spec, 'JPEG', '.jpg', options)
+  if name == 'webp':
+    options = {'quality': int(quality or DEFAULT_QUALITY['webp']), 'method': 4}
+    return StorageCodec(spec, 'WEBP', '.webp', options)
+  raise ValueError(f'unknown storage codec {spec}, expected png[:level], jpeg[:quality] or webp[:quality]')
+
+
+def encode(im, codec):
+  # the image encoded in memory
+  buffer = io.BytesIO()
+  im.save(buffer, format=codec.format, **codec.options)
+  return buffer.getvalue()
@@ -0,0 +1,62 @@
+import os
+import sys
+
+from collections import Counter
+
+from PIL import Image
+from torchvision import transforms
+from torchvision.datasets.folder import IMG_EXTENSIONS
+
+instructions_path = 'refined_instructions.txt'
+# the image store written by the downloaders, e.g. with --ingest
+ROOTS = ['res_grade', 'cap_cul']
+
+# resize data for training, as in perform_sanitise_instructions.py; a no-op for ingested 512 px images
+t_512 = transforms.Resize(512)
+
+
+def load_mapping(path=instructions_path):
+  # the refined sanitation instructions as (source class, target class) pairs:
+  # D drops the source, K keeps it, R renames it and M merges several sources into one class
+  mapping = []
+  for i in open(path, 'r').read().split('\n'):
+    if ',' in i:
+      parsed_i = i.split(',')
+      if parsed_i[0] == 'K':
+        mapping.append((parsed_i[1], parsed_i[1]))
+      elif parsed_i[0] == 'R':
+        mapping.append((parsed_i[2], parsed_i[1]))
+      elif parsed_i[0] == 'M':
+        mapping += [(p_i, parsed_i[1]) for p_i in parsed_i[2:]]
+  return mapping
+
+
+def index_images(mapping, roots=ROOTS):
+  # (image path, target class) of every stored image of the mapped source classes, in class and file order;
+  # the first source of a merged class wins a file name clash, as in perform_sanitise_instructions.py
+  images = {}
+  for source, target in mapping:
+    for root in roots:
+      if not os.path.isdir(f'{root}/{source}'):
+        continue
+      for filename in os.listdir(f'{root}/{source}'):
+        if filename.lower().endswith(IMG_EXTENSIONS):
+          images.setdefault((target, filename.split('.')[0]), f'{root}/{source}/{filename}')
+  return [(path, target) for (target, _), path in sorted(images.items())]
+
+
+def load_image(path):
+  with open(path, 'rb') as f:
+    return t_512(Image.open(f).convert('RGB'))
+
+
+# print the classes and image counts of the mapped dataset: python label_mapping.py [instructions]
+if __name__ == '__main__':
+  mapping = load_mapping(sys.argv[1] if len(sys.argv) > 1 else instructions_path)
+  images = index_images(mapping)
+  counts = Counter(target for _, target in images)
+  classes = {target for _, target in mapping}
+  print(f'{len(mapping)} source classes mapped onto {len(classes)} classes, {len(images)} images')
+  empty = sorted(classes - set(counts))
+  if empty:
+    print(f'{len(empty)} classes without images: {", ".join(empty)}')
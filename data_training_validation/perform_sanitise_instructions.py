@@ -1,65 +1,103 @@
 import os
+import sys
+import shutil
 
+from collections import Counter
+from functools import partial
 from PIL import Image
 from tqdm import tqdm
 from torchvision import transforms
 from multiprocessing.pool import Pool
 
+from image_codec import CODEC_EXTENSIONS, DEFAULT_CODEC, get_codec
+from label_mapping import load_mapping
+
 # resize data for training
 t_512 = transforms.Resize(512)
+# one process per available core
+NUM_PROCESSES = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+# images handed to a process at once: large enough to amortise the inter-process overhead,
+# small enough to keep every process busy until the end
+MAX_CHUNKSIZE = 64
+# images that could not be sanitised, and classes without images
+failures_path = 'sanitise_failures.txt'
+
+# whether an image is already stored as sanitised, e.g. by the downloaders' ingest mode;
+# only lossless PNGs are reused as they are, any other codec needs its own encoding
+def is_sanitised(im, codec):
+  return codec.format == 'PNG' and im.format == 'PNG' and im.mode == 'RGB' and min(im.size) == 512
 
-# move one image for sanitation
-def move_single(source, target):
+# remove the copies of an image stored by an earlier run with another codec, which would be listed twice by split.py
+def remove_other_codecs(target, codec):
+  stem = os.path.splitext(target)[0]
+  for extension in CODEC_EXTENSIONS:
+    if extension != codec.extension and os.path.exists(stem + extension):
+      os.remove(stem + extension)
+
+# move one image for sanitation, stored with the codec; returns (source, target, error) if it fails
+def move_single(task, codec):
+  source, target = task
   if os.path.exists(target):
-    return
+    remove_other_codecs(target, codec)
+    return None
   try:
+    # opening only reads the header, the pixels are decoded by the resize
     im = Image.open(source)
-    t_512(im).save(target, format='PNG', optimize=True)
-  # log problematic images that cannot be opened or resized
-  except:
-    print(source, target, flush=True)
-  return
-
-# move images using multiprocessing
-pool = Pool(processes=96)
+    if is_sanitised(im, codec):
+      # link the file into place instead of decoding and encoding it again
+      try:
+        os.link(source, target)
+      except OSError:
+        shutil.copyfile(source, target)
+    else:
+      t_512(im).save(target, format=codec.format, **codec.options)
+    # only once the image is stored with the new codec
+    remove_other_codecs(target, codec)
+  # report problematic images that cannot be opened or resized
+  except Exception as e:
+    return source, target, f'{type(e).__name__}: {e}'
+  return None
 
-# move one class for sanitation
-def move(source, target):
-  if not os.path.exists(f'dataset/{target}/'):
-    os.mkdir(f'dataset/{target}/')
-  # collect images to move into the sanitised class
-  move_list = []
-  # collect research-grade instances
-  if os.path.exists(f'res_grade/{source}/'):
-    move_list += [(f'res_grade/{source}/{filename}', f"dataset/{target}/{filename.split('.')[0]}.png") for filename in os.listdir(f'res_grade/{source}/')]
-  # collect captive/cultivated instances
-  if os.path.exists(f'cap_cul/{source}/'):
-    move_list += [(f'cap_cul/{source}/{filename}', f"dataset/{target}/{filename.split('.')[0]}.png") for filename in os.listdir(f'cap_cul/{source}/')]
-  # perform the move
-  if move_list:
-    pool.starmap(move_single, move_list)
-  # log problematic empty classes
-  else:
-    print(source, target, flush=True)
-  return
+# images of one source class to move into a sanitised class
+def expand(source, target, extension):
+  tasks = []
+  # collect research-grade and captive/cultivated instances
+  for root in ['res_grade', 'cap_cul']:
+    if os.path.exists(f'{root}/{source}/'):
+      tasks += [(f'{root}/{source}/{filename}', f"dataset/{target}/{filename.split('.')[0]}{extension}") for filename in os.listdir(f'{root}/{source}/')]
+  return tasks
 
-# read refined sanitation instructions
-instructions = open('refined_instructions.txt', 'r').read().split('\n')
-for i in tqdm(instructions):
-  if ',' in i:
-    parsed_i = i.split(',')
-    # delete
-    if parsed_i[0] == 'D':
-      pass
-    # keep
-    elif parsed_i[0] == 'K':
-      move(parsed_i[1], parsed_i[1])
-    # rename
-    elif parsed_i[0] == 'R':
-      move(parsed_i[2], parsed_i[1])
-    # merge
-    elif parsed_i[0] == 'M':
-      for p_i in parsed_i[2:]:
-        move(p_i, parsed_i[1])
-# clean up
-pool.terminate()
+if __name__ == '__main__':
+  # storage format of the dataset, e.g. --codec=webp:90 (see image_codec.py)
+  codec = get_codec(next((arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--codec=')), DEFAULT_CODEC))
+  # one stream of images across all classes, so that no process waits for the rest of a class to finish
+  tasks = {}
+  empty_classes = []
+  for source, target in tqdm(load_mapping('refined_instructions.txt'), desc='listing'):
+    os.makedirs(f'dataset/{target}/', exist_ok=True)
+    class_tasks = expand(source, target, codec.extension)
+    if not class_tasks:
+      empty_classes.append((source, target))
+    # the first source of a merged class wins a filename clash, as when classes were moved one at a time
+    for source_path, target_path in class_tasks:
+      tasks.setdefault(target_path, source_path)
+  tasks = [(source_path, target_path) for target_path, source_path in tasks.items()]
+  chunksize = max(1, min(MAX_CHUNKSIZE, len(tasks) // (NUM_PROCESSES * 16)))
+  # move images using multiprocessing
+  failures = []
+  with Pool(processes=NUM_PROCESSES) as pool:
+    for failure in tqdm(pool.imap_unordered(partial(move_single, codec=codec), tasks, chunksize=chunksize), total=len(tasks), desc='moving'):
+      if failure:
+        failures.append(failure)
+  # report problems once, after the progress bar
+  with open(failures_path, 'w') as f:
+    for source, target, error in sorted(failures):
+      f.write(f'{source},{target},{error}\n')
+    for source, target in empty_classes:
+      f.write(f'{source},{target},empty class\n')
+  print(f'{len(tasks) - len(failures)} of {len(tasks)} images sanitised as {codec.name} with {NUM_PROCESSES} processes')
+  for error, count in Counter(error.split(':')[0] for _, _, error in failures).most_common():
+    print(f'{count} images failed with {error}')
+  print(f'{len(empty_classes)} classes without images')
+  if failures or empty_classes:
+    print(f'details in {failures_path}')
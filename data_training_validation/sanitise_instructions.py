@@ -4,16 +4,19 @@ import pandas as pd
 
 from tqdm import tqdm
 
+from gbif_export import load_gbif_index
+
 def format_row(row):
   if row['taxonRank'] in ['SUBSPECIES', 'VARIETY', 'FORM']:
     return (row['species'], row['taxonRank'])
   return (row[row['taxonRank'].lower()], row['taxonRank'])
 
 # handle research-grade classes
-info = pd.read_csv('NZ-Species.csv', delimiter = '\t')
+# the taxonomy of every label, indexed by label, from the Parquet cache of the export
+info = load_gbif_index('verbatimScientificName', ['taxonRank', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species'])
 classes = {}
 for class_name in sorted(os.listdir('res_grade')):
-  row = info[info['verbatimScientificName'] == class_name].iloc[0]
+  row = info.loc[class_name]
   classes[class_name] = format_row(row)
 new_classes = {}
 # sanitise classes with standardising hybrid names
@@ -1,45 +1,82 @@
 import os
-import pickle
-import random
-import shutil
+import sys
 
 from tqdm import tqdm
 
-random.seed(0)
-classes = os.listdir('dataset')
-# split into training and test sets
-os.makedirs('dataset/train')
-os.makedirs('dataset/test')
-# record the number of training observations in each class
-instance_count = {}
-for class_i in tqdm(classes):
-  image_files = os.listdir(f'dataset/{class_i}')
+from label_mapping import index_images, load_mapping
+from split_manifest import (hash_fold, load_manifest, manifest_path, observation_hash, observation_id, save_instance_count,
+                            save_manifest)
+
+# options: --mapped indexes res_grade and cap_cul through refined_instructions.txt instead of listing dataset/,
+# --folds=<k> --fold=<i> puts the i-th of k folds of the observations into the test set (default: the first of 10)
+options = dict(arg[2:].partition('=')[::2] for arg in sys.argv[1:] if arg.startswith('--'))
+folds = int(options.get('folds', 10))
+fold = int(options.get('fold', 0))
+output_path = manifest_path if (folds, fold) == (10, 0) else f'split_manifest_fold{fold}of{folds}.csv'
+
+# image files of a class directory, leaving out anything that isn't a regular file
+def list_images(directory):
+  return [f'{directory}/{image_file}' for image_file in sorted(os.listdir(directory)) if os.path.isfile(f'{directory}/{image_file}')]
+
+# class directories of a dataset directory
+def list_classes(directory, exclude=()):
+  return [class_i for class_i in sorted(os.listdir(directory)) if class_i not in exclude and os.path.isdir(f'{directory}/{class_i}')]
+
+# observations keep the split they were given by earlier runs, so only new ones are assigned
+previous = {}
+if os.path.exists(output_path):
+  previous = {(row['class'], row['observation']): row['split'] for row in load_manifest(output_path)}
+# collect the images of each class
+images = {}
+if 'mapped' in options:
+  for path, class_i in index_images(load_mapping()):
+    images.setdefault(class_i, []).append(path)
+else:
+  # a dataset split into train/ and test/ directories by an earlier version of this script keeps that split:
+  # its images stay where they are and the directory they are in seeds their split in the default manifest
+  for split in ['train', 'test']:
+    if os.path.isdir(f'dataset/{split}'):
+      for class_i in list_classes(f'dataset/{split}'):
+        for path in list_images(f'dataset/{split}/{class_i}'):
+          images.setdefault(class_i, []).append(path)
+          if output_path == manifest_path:
+            previous.setdefault((class_i, observation_id(os.path.basename(path))), split)
+  # a dataset merged back into full/ by the former merge.py has lost its split, so its images are indexed in place
+  # like any other unsplit class
+  if os.path.isdir('dataset/full'):
+    for class_i in list_classes('dataset/full'):
+      images.setdefault(class_i, []).extend(list_images(f'dataset/full/{class_i}'))
+  for class_i in list_classes('dataset', exclude=['train', 'test', 'full']):
+    images.setdefault(class_i, []).extend(list_images(f'dataset/{class_i}'))
+# split into training and test sets, recording the split of every image rather than moving it
+rows = []
+for class_i in tqdm(sorted(images)):
   # log problematic empty class
-  if not image_files:
+  if not images[class_i]:
     print(f'empty class {class_i}')
     continue
   instances = {}
   # count observations
-  for image_file in image_files:
-    instance_id = image_file.split('.')[0].split('_')[-1]
-    if instance_id in instances:
-      instances[instance_id].append(image_file)
-    else:
-      instances[instance_id] = [image_file]
-  num = len(instances)
-  instance_ids = list(instances.keys())
-  # move all instances into the training set before splitting into the test set
-  shutil.move(f'dataset/{class_i}', f'dataset/train/{class_i}')
-  os.makedirs(f'dataset/test/{class_i}')
-  instance_count_i = len(instance_ids)
-  # if there is only one observation, keep it in the training set
-  if num > 1:
-    # randomly split 10% of the observations into the test set
-    random.shuffle(instance_ids)
-    for instance_id in instance_ids[::10]:
-      for image_file in instances[instance_id]:
-        os.rename(f'dataset/train/{class_i}/{image_file}', f'dataset/test/{class_i}/{image_file}')
-      instance_count_i -= 1
-  instance_count[class_i] = instance_count_i
-# save training observation count for validation later on
-pickle.dump(instance_count, open('instance_count.pkl', 'wb'))
+  for path in images[class_i]:
+    instances.setdefault(observation_id(os.path.basename(path)), []).append(path)
+  splits = {instance_id: previous.get((class_i, instance_id)) for instance_id in instances}
+  # a new observation goes into the test set if its hash falls into the test fold
+  for instance_id in sorted(i for i, split in splits.items() if split is None):
+    splits[instance_id] = 'test' if hash_fold(instance_id, folds) == fold else 'train'
+  new_ids = sorted((i for i in instances if (class_i, i) not in previous), key=observation_hash)
+  # keep at least one observation in the training set, e.g. the only one of a class
+  if 'train' not in splits.values():
+    splits[new_ids[0] if new_ids else min(splits)] = 'train'
+  # and give a class with more than one observation at least one test observation: the new one with the lowest hash,
+  # so that observations already in the manifest never move
+  elif len(splits) > 1 and 'test' not in splits.values() and new_ids:
+    splits[new_ids[0]] = 'test'
+  for instance_id, paths in instances.items():
+    for path in paths:
+      rows.append({'path': path, 'class': class_i, 'observation': instance_id, 'split': splits[instance_id]})
+save_manifest(rows, output_path)
+# save training observation count of the default split for validation later on
+if output_path == manifest_path:
+  save_instance_count(rows)
+new = sum((row['class'], row['observation']) not in previous for row in rows)
+print(f"{new} new images assigned, {len(rows)} images of {len({row['class'] for row in rows})} classes split into {output_path}")
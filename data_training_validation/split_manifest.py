@@ -0,0 +1,76 @@
+import os
+import csv
+import pickle
+import hashlib
+
+from collections import defaultdict
+
+from torchvision.datasets import DatasetFolder
+from torchvision.datasets.folder import IMG_EXTENSIONS
+
+from label_mapping import load_image
+
+manifest_path = 'split_manifest.csv'
+instance_count_path = 'instance_count.pkl'
+# one row per image; the split is 'train' or 'test'
+MANIFEST_COLUMNS = ['path', 'class', 'observation', 'split']
+
+
+def observation_id(filename):
+  # images are stored as <row index>_<observation id>.<extension>
+  return filename.split('.')[0].split('_')[-1]
+
+
+def observation_hash(observation):
+  # stable hash of an observation ID, the same on every run and whatever else is in the dataset
+  return int.from_bytes(hashlib.sha256(observation.encode()).digest()[:8], 'big')
+
+
+def hash_fold(observation, folds):
+  return observation_hash(observation) % folds
+
+
+def load_manifest(path=manifest_path):
+  with open(path, newline='') as f:
+    return list(csv.DictReader(f))
+
+
+def save_manifest(rows, path=manifest_path):
+  # written under a temporary name and renamed, so that a split is replaced in one step
+  with open(path + '.part', 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+  os.replace(path + '.part', path)
+
+
+def instance_counts(rows, split='train'):
+  # number of observations per class in the split, for binning validation results by class size
+  observations = defaultdict(set)
+  for row in rows:
+    if row['split'] == split:
+      observations[row['class']].add(row['observation'])
+  return {class_name: len(ids) for class_name, ids in observations.items()}
+
+
+def save_instance_count(rows, path=instance_count_path):
+  pickle.dump(instance_counts(rows), open(path, 'wb'))
+
+
+class ManifestDataset(DatasetFolder):
+  # the images of one split of a manifest, where 'full' is every image; classes and class_to_idx cover every
+  # class of the manifest, so that all splits share them as ImageFolders over dataset/train and dataset/test did
+  def __init__(self, manifest=manifest_path, split='train', transform=None, target_transform=None):
+    self.rows = load_manifest(manifest)
+    self.split = split
+    super().__init__(os.path.dirname(os.path.abspath(manifest)), load_image, IMG_EXTENSIONS, transform=transform,
+                     target_transform=target_transform)
+    self.imgs = self.samples
+
+  def find_classes(self, directory):
+    classes = sorted({row['class'] for row in self.rows})
+    return classes, {class_name: i for i, class_name in enumerate(classes)}
+
+  def make_dataset(self, directory, class_to_idx, extensions=None, is_valid_file=None):
+    return [(os.path.join(directory, row['path']), class_to_idx[row['class']]) for row in self.rows
+            if self.split == 'full' or row['split'] == self.split]
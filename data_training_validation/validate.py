@@ -3,15 +3,15 @@ import sys
 import math
 import timm
 import torch
-import pickle
 
 import numpy as np
 import torch.nn as nn
-import torchvision.datasets as datasets
 import torchvision.transforms as transforms
 
 from torch.utils.tensorboard import SummaryWriter
 
+from split_manifest import ManifestDataset, instance_counts, load_manifest
+
 # abstention with top-1 confidence
 def confidence_mask(probabilities, threshold):
     return probabilities.max(1)[0] > threshold
@@ -28,6 +28,8 @@ def entropy_mask(probabilities, threshold):
 # splits for validation
 # so that the training split can also be validated for sanity checking
 splits = ['test']
+# manifest written by split.py, e.g. split_manifest_fold1of5.csv for cross-validation
+split_manifest = 'split_manifest.csv'
 # abstention methods
 abstentions = {'confidence': confidence_mask, 'margin':margin_mask, 'entropy':entropy_mask}
 # abstention thresholds
@@ -45,8 +47,9 @@ tools = {}
 for split in splits:
     tools[split] = {}
     # data pipeline
-    tools[split]['loader'] = torch.utils.data.DataLoader(datasets.ImageFolder(
-        f"dataset/{split}",
+    tools[split]['loader'] = torch.utils.data.DataLoader(ManifestDataset(
+        split_manifest,
+        split,
         transforms.Compose([
             transforms.Resize(416 if model_size == 's' else 512),
             transforms.CenterCrop(384 if model_size == 's' else 480),
@@ -60,7 +63,7 @@ for split in splits:
     for abstention in abstentions:
         tools[split][f'writer_{abstention}'] = SummaryWriter(f'{checkpoints_dir}/test/{abstention}_{split}')
 # collect classes into bins by number of training observations
-instance_count = pickle.load(open('instance_count.pkl', 'rb'))
+instance_count = instance_counts(load_manifest(split_manifest))
 class_bins = {v: (0 if instance_count[k] < 5 else (1 if instance_count[k] < 10 else (2 if instance_count[k] < 20 else (3 if instance_count[k] < 50 else 4)))) for k, v in tools['test']['loader'].dataset.class_to_idx.items()}
 # iterate through checkpoints
 for epoch in range(int(sys.argv[3]), int(sys.argv[4]) + 5, 5):